@@ -0,0 +1,221 @@
+"""
+Benchmarks and load tests for Invite0, against local stand-ins for Auth0 and the mail server
+
+    python -m bench bulk --addresses 10000          # a bulk invite job
+    python -m bench bulk --kind provision           # a bulk provision job
+    python -m bench web --clients 20 --seconds 30   # /admin and /my-account under gunicorn
+    python -m bench signup --signups 500            # a burst of signups under gunicorn
+
+Each prints throughput, p50/p99 latency, and peak RSS; add `--output results.jsonl` to keep them
+for comparison. See bench/README.md.
+"""
+import argparse
+import os
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import cycle
+
+from bench.common import (
+    ROOT, child_pids, free_port, peak_rss_kb, process, report, stand_ins,
+)
+
+
+def _addresses(count):
+    # spread over a few domains, like a real roster
+    return (f'bench.user{i}@dept{i % 20}.example.com' for i in range(count))
+
+
+def bulk(options, env):
+    os.environ.update(env, INVITE0_DOMAIN='localhost:8000', BULK_INVITE_MODE=options.mode)
+    import invite0  # noqa -- starts the bulk invite workers
+    from invite0 import app, jobs
+
+    with app.app_context():
+        submitted_at = time.monotonic()
+        job_id = jobs.submit_bulk_invite(_addresses(options.addresses), 'bench@example.com',
+                                         options.kind)
+        submit_s = time.monotonic() - submitted_at
+        while jobs.progress(job_id)['state'] == 'queued':
+            time.sleep(0.5)
+        conn = jobs._db()
+        job = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        # how long each address waited, from the start of the job
+        latencies = [row[0] for row in conn.execute(
+            'SELECT done_at - ? FROM job_addresses WHERE job_id = ?', (job['started_at'], job_id)
+        )]
+        counts = jobs.address_counts(job_id)
+
+    report(
+        'bulk',
+        {'addresses': options.addresses, 'mode': options.mode, 'kind': options.kind},
+        count=options.addresses,
+        elapsed=job['finished_at'] - job['started_at'],
+        latencies=latencies,
+        peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        output=options.output,
+        state=job['state'],
+        submit_s=round(submit_s, 3),
+        **counts,
+    )
+
+
+@contextmanager
+def _gunicorn(options, env):
+    port = free_port()
+    gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    args = [gunicorn, '--config=gunicorn.conf.py', f'--bind=127.0.0.1:{port}',
+            f'--workers={options.workers}', '--log-level=warning', 'invite0:app']
+    with process(args, port, env={**os.environ, **env, 'INVITE0_DOMAIN': f'localhost:{port}'}) \
+            as proc:
+        time.sleep(1)  # let the rest of the workers boot
+        yield proc, f'http://localhost:{port}'
+
+
+def _workers_peak_rss(proc):
+    return sum(peak_rss_kb(pid) for pid in child_pids(proc.pid))
+
+
+def _logged_in_session(base_url):
+    import requests
+    session = requests.Session()
+    response = session.get(f'{base_url}/login')  # and through the fake Auth0 and back
+    response.raise_for_status()
+    return session
+
+
+def web(options, env):
+    os.environ.update(env)  # for the clients to trust the fake Auth0
+    with _gunicorn(options, env) as (proc, base_url):
+        deadline = time.monotonic() + options.seconds
+        latencies, errors = [], []
+
+        def client():
+            session = _logged_in_session(base_url)
+            for path in cycle(['/admin', '/my-account']):
+                if time.monotonic() > deadline:
+                    return
+                started_at = time.perf_counter()
+                response = session.get(f'{base_url}{path}', allow_redirects=False)
+                latencies.append(time.perf_counter() - started_at)
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+
+        started_at = time.monotonic()
+        threads = [threading.Thread(target=client) for _ in range(options.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started_at
+        peak_rss = _workers_peak_rss(proc)
+
+    report(
+        'web',
+        {'clients': options.clients, 'workers': options.workers},
+        count=len(latencies),
+        elapsed=elapsed,
+        latencies=latencies,
+        peak_rss=peak_rss,
+        output=options.output,
+        errors=len(errors),
+    )
+
+
+_CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def signup(options, env):
+    import requests
+    from itsdangerous import URLSafeTimedSerializer
+
+    os.environ.update(env)
+    serializer = URLSafeTimedSerializer(env['SECRET_KEY'])  # as in invite0.tokens
+    tokens = [serializer.dumps(address) for address in _addresses(options.signups)]
+
+    with _gunicorn(options, env) as (proc, base_url):
+        # fetch the forms first, so that the burst is just the submissions
+        forms = []
+        for token in tokens:
+            session = requests.Session()
+            page = session.get(f'{base_url}/signup/{token}')
+            forms.append((session, token, _CSRF_TOKEN.search(page.text).group(1)))
+
+        def submit(form):
+            session, token, csrf_token = form
+            started_at = time.perf_counter()
+            response = session.post(f'{base_url}/signup/{token}', allow_redirects=False, data={
+                'csrf_token': csrf_token,
+                'password': 'Bench-passw0rd!',
+                'confirm_password': 'Bench-passw0rd!',
+                'submit': 'Create account',
+            })
+            return time.perf_counter() - started_at, response.status_code == 302
+
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(options.concurrency) as pool:
+            results = list(pool.map(submit, forms))
+        elapsed = time.monotonic() - started_at
+        peak_rss = _workers_peak_rss(proc)
+
+    report(
+        'signup',
+        {'signups': options.signups, 'concurrency': options.concurrency,
+         'workers': options.workers},
+        count=len(results),
+        elapsed=elapsed,
+        latencies=[latency for latency, _ in results],
+        peak_rss=peak_rss,
+        output=options.output,
+        created=sum(created for _, created in results),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help='append results to this file as JSON lines')
+    parser.add_argument('--auth0-latency-ms', type=float, default=50)
+    parser.add_argument('--auth0-rate', type=float, default=15,
+                        help='Management API requests/second, 0 for no limit')
+    parser.add_argument('--auth0-burst', type=int, default=50)
+    parser.add_argument('--auth0-error-percent', type=float, default=0,
+                        help='percentage of Management API requests that fail with a 503')
+    parser.add_argument('--auth0-import-seconds', type=float, default=5,
+                        help='how long user imports take')
+    parser.add_argument('--smtp-latency-ms', type=float, default=20)
+    parser.add_argument('--existing-percent', type=int, default=10,
+                        help='percentage of addresses that already have an account')
+    scenarios = parser.add_subparsers(dest='scenario', required=True)
+
+    parser_bulk = scenarios.add_parser('bulk', help='run a bulk invite job')
+    parser_bulk.add_argument('--addresses', type=int, default=1000)
+    parser_bulk.add_argument('--mode', choices=['threads', 'asyncio'], default='threads')
+    parser_bulk.add_argument('--kind', choices=['invite', 'provision'], default='invite')
+    parser_bulk.set_defaults(run=bulk)
+
+    parser_web = scenarios.add_parser('web', help='load /admin and /my-account')
+    parser_web.add_argument('--clients', type=int, default=20)
+    parser_web.add_argument('--seconds', type=float, default=30)
+    parser_web.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser_web.set_defaults(run=web)
+
+    parser_signup = scenarios.add_parser('signup', help='submit a burst of signups')
+    parser_signup.add_argument('--signups', type=int, default=200)
+    parser_signup.add_argument('--concurrency', type=int, default=50)
+    parser_signup.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser_signup.set_defaults(run=signup)
+
+    options = parser.parse_args()
+    sys.path.insert(0, ROOT)
+    with tempfile.TemporaryDirectory(prefix='invite0-bench-') as workdir:
+        with stand_ins(options, workdir) as env:
+            options.run(options, env)
+
+
+if __name__ == '__main__':
+    main()
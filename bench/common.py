@@ -0,0 +1,143 @@
+"""
+Plumbing shared by the scenarios: stand-in servers, Invite0's environment, and reporting
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def make_certificate(directory):
+    """Self-signed certificate for localhost, for the fake Auth0. Returns (cert, key) paths."""
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+         '-keyout', key, '-out', cert],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+@contextmanager
+def process(args, port, **kwargs):
+    """Run `args` in the background until the block exits, waiting for it to listen on `port`"""
+    proc = subprocess.Popen(args, cwd=ROOT, **kwargs)
+    try:
+        wait_for_port(port)
+        yield proc
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+@contextmanager
+def stand_ins(options, workdir):
+    """
+    Run the fake Auth0 and SMTP servers, yielding the environment for an Invite0 that uses them
+    """
+    cert, key = make_certificate(workdir)
+    auth0_port, smtp_port = free_port(), free_port()
+    auth0_args = [
+        sys.executable, '-m', 'bench.fake_auth0', '--port', str(auth0_port),
+        '--cert', cert, '--key', key,
+        '--latency-ms', str(options.auth0_latency_ms),
+        '--rate', str(options.auth0_rate),
+        '--burst', str(options.auth0_burst),
+        '--existing-percent', str(options.existing_percent),
+        '--error-percent', str(options.auth0_error_percent),
+        '--import-seconds', str(options.auth0_import_seconds),
+    ]
+    smtp_args = [
+        sys.executable, '-m', 'bench.smtp_sink', '--port', str(smtp_port),
+        '--latency-ms', str(options.smtp_latency_ms),
+    ]
+    with process(auth0_args, auth0_port), process(smtp_args, smtp_port):
+        yield {
+            'ORG_NAME': 'Bench',
+            'SECRET_KEY': 'bench',
+            'DATA_DIR': os.path.join(workdir, 'data'),
+            'MAIL_SERVER': '127.0.0.1',
+            'MAIL_PORT': str(smtp_port),
+            'MAIL_USERNAME': '',
+            'MAIL_PASSWORD': '',
+            'MAIL_SENDER_ADDRESS': 'invite0@example.com',
+            'AUTH0_CLIENT_ID': 'bench',
+            'AUTH0_CLIENT_SECRET': 'bench',
+            'AUTH0_AUDIENCE': 'bench',
+            'AUTH0_DOMAIN': f'localhost:{auth0_port}',
+            'AUTH0_MGMT_API_RATE_LIMIT': str(options.auth0_rate or 1000),
+            'AUTH0_MGMT_API_BURST': str(options.auth0_burst),
+            # trust the fake Auth0's certificate: requests reads the first, aiohttp the second
+            'REQUESTS_CA_BUNDLE': cert,
+            'SSL_CERT_FILE': cert,
+        }
+
+
+def peak_rss_kb(pid) -> int:
+    """High-water mark of a process's resident memory (Linux only)"""
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return 0
+
+
+def child_pids(pid) -> List[int]:
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def report(scenario: str, params: Dict, count: int, elapsed: float, latencies: List[float],
+           peak_rss: int, output=None, **extra):
+    """Print a scenario's results, and append them to `output` (JSON lines) if given"""
+    result = {
+        'scenario': scenario,
+        **params,
+        'count': count,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(count / elapsed, 2) if elapsed else None,
+        'p50_ms': latencies and round(percentile(latencies, 50) * 1000, 1),
+        'p99_ms': latencies and round(percentile(latencies, 99) * 1000, 1),
+        'peak_rss_mb': round(peak_rss / 1024, 1),
+        **extra,
+    }
+    width = max(len(key) for key in result)
+    for key, value in result.items():
+        print(f'{key:<{width}}  {value}')
+    if output:
+        with open(output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+    return result
@@ -0,0 +1,239 @@
+"""
+A stand-in for an Auth0 tenant, covering just the endpoints Invite0 uses
+
+    python -m bench.fake_auth0 --port 8443 --cert cert.pem --key key.pem --latency-ms 50
+
+Invite0 only talks to Auth0 over HTTPS, so this serves HTTPS with the given certificate (see
+`bench.common.make_certificate`). Every request waits `--latency-ms`, and Management API
+requests are rate limited like the real thing: a token bucket of `--burst` requests refilled at
+`--rate` per second, reported in `X-RateLimit-*` headers, with 429s when it's empty. To see how
+Invite0 copes with a degraded tenant, `--error-percent` of them fail with a 503.
+
+Users don't need to be created beforehand: an address "exists" if a hash of it falls within
+`--existing-percent`, so the same addresses get the same answers from run to run. User imports
+(for provision jobs) complete `--import-seconds` after they're submitted, and report those that
+exist as duplicates.
+"""
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import random
+import re
+import ssl
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+
+BENCH_USER_ID = 'auth0|bench'
+BENCH_USER = {
+    'user_id': BENCH_USER_ID,
+    'email': 'bench@example.com',
+    'nickname': 'bench',
+    'given_name': 'Bench',
+    'family_name': 'Mark',
+    'picture': 'https://example.com/bench.png',
+}
+
+
+class _Bucket:
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.time()
+
+    def take(self):
+        """:return: (allowed, remaining, reset epoch seconds)"""
+        with self.lock:
+            now = time.time()
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            allowed = not self.rate or self.tokens >= 1
+            if allowed and self.rate:
+                self.tokens -= 1
+            until_full = (self.burst - self.tokens) / self.rate if self.rate else 0
+            return allowed, int(self.tokens), int(now + until_full) + 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real thing
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None, headers=None):
+        content = b'' if body is None else (
+            body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        )
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f'Content-Type: {content_type}\r\n\r\n'.encode() + body
+            )
+            return {part.get_param('name', header='content-disposition'): part.get_content()
+                    for part in message.iter_parts()}
+        if content_type.startswith('application/json'):
+            return json.loads(body or '{}')
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def _handle(self, method):
+        options = self.server.options
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        form = self._form() if method in ('POST', 'PATCH') else {}
+        time.sleep(options.latency_ms / 1000)
+
+        if not url.path.startswith('/api/v2/'):
+            return self._authentication_api(method, url.path, query, form)
+
+        allowed, remaining, reset = self.server.bucket.take()
+        headers = {
+            'X-RateLimit-Limit': str(options.burst),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(reset),
+        }
+        if not allowed:
+            return self._reply(429, {'statusCode': 429, 'message': 'Too Many Requests'}, headers)
+        if random.uniform(0, 100) < options.error_percent:
+            return self._reply(503, {'statusCode': 503, 'message': 'Service Unavailable'})
+        status, body = self._management_api(method, url.path[len('/api/v2'):], query, form)
+        self._reply(status, body, headers)
+
+    def _authentication_api(self, method, path, query, form):
+        if method == 'GET' and path == '/authorize':
+            # log straight in and go back to the app
+            params = urlencode({'code': 'bench-code', 'state': query.get('state', '')})
+            self.send_response(302)
+            self.send_header('Location', f"{query['redirect_uri']}?{params}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif method == 'POST' and path == '/oauth/token':
+            self._reply(200, {
+                'access_token': f"bench-{form.get('grant_type')}-token",
+                'token_type': 'Bearer',
+                'expires_in': 86400,
+                'scope': 'openid profile email',
+            })
+        elif method == 'GET' and path == '/userinfo':
+            self._reply(200, {'sub': BENCH_USER_ID, 'email': BENCH_USER['email']})
+        elif method == 'POST' and path == '/dbconnections/change_password':
+            self._reply(200, "We've just sent you an email to reset your password.")
+        else:
+            self._reply(404, {'message': f'Not found: {method} {path}'})
+
+    def _exists(self, email_address):
+        bucket = zlib.crc32(email_address.lower().encode()) % 100
+        return bucket < self.server.options.existing_percent
+
+    def _management_api(self, method, resource, query, form):
+        if method == 'GET' and resource == '/users-by-email':
+            email_address = query.get('email', '')
+            return 200, [{'email': email_address.lower()}] if self._exists(email_address) else []
+        if method == 'GET' and resource == '/users':
+            emails = re.findall(r'"((?:[^"\\]|\\.)*)"', query.get('q', ''))
+            users = [{'email': email.lower()} for email in emails if self._exists(email)]
+            page, per_page = int(query.get('page', 0)), int(query.get('per_page', 50))
+            return 200, {
+                'users': users[page * per_page:(page + 1) * per_page],
+                'start': page * per_page,
+                'limit': per_page,
+                'total': len(users),
+            }
+        if method == 'GET' and resource == '/connections':
+            return 200, [{'id': 'con_bench'}]
+        if method == 'POST' and resource == '/jobs/users-imports':
+            job_id = f'job_{next(self.server.job_ids)}'
+            users = json.loads(form['users'])
+            self.server.imports[job_id] = (time.time(), [user['email'] for user in users])
+            return 201, {'id': job_id, 'type': 'users_import', 'status': 'pending'}
+        match = re.match(r'^/jobs/([^/]+)(/errors)?$', resource)
+        if match and method == 'GET' and match.group(1) in self.server.imports:
+            submitted_at, emails = self.server.imports[match.group(1)]
+            if not match.group(2):
+                done = time.time() - submitted_at >= self.server.options.import_seconds
+                return 200, {'id': match.group(1), 'status': 'completed' if done else 'processing'}
+            errors = [
+                {'user': {'email': email_address},
+                 'errors': [{'code': 'DUPLICATED_USER', 'message': 'The user already exists.'}]}
+                for email_address in emails if self._exists(email_address)
+            ]
+            return (200, errors) if errors else (204, None)
+        if method == 'POST' and resource == '/tickets/password-change':
+            return 201, {'ticket': f'https://{self.headers["Host"]}/lo/reset?ticket=bench'}
+        if method == 'POST' and resource == '/users':
+            if self._exists(form.get('email', '')):
+                return 409, {'statusCode': 409, 'message': 'The user already exists.'}
+            return 201, {'user_id': 'auth0|new', 'email': form.get('email')}
+        match = re.match(r'^/users/([^/]+)(/permissions)?$', resource)
+        if match and match.group(2) and method == 'GET':
+            return 200, {
+                'permissions': [{'permission_name': 'send:invitation'}],
+                'start': 0,
+                'limit': 50,
+                'total': 1,
+            }
+        if match and method == 'GET':
+            return 200, BENCH_USER
+        if match and method == 'PATCH':
+            return 200, {**BENCH_USER, **form}
+        return 404, {'statusCode': 404, 'message': f'Not found: {method} {resource}'}
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+
+def serve(port, cert, key, options):
+    server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    server.daemon_threads = True
+    server.options = options
+    server.bucket = _Bucket(options.rate, options.burst)
+    server.imports = {}  # job ID -> (time submitted, email addresses)
+    server.job_ids = itertools.count(1)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--cert', required=True)
+    parser.add_argument('--key', required=True)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Management API requests/second, 0 for no limit')
+    parser.add_argument('--burst', type=int, default=50)
+    parser.add_argument('--existing-percent', type=int, default=10)
+    parser.add_argument('--error-percent', type=float, default=0)
+    parser.add_argument('--import-seconds', type=float, default=5)
+    options = parser.parse_args()
+    serve(options.port, options.cert, options.key, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+An SMTP server that accepts everything and throws it away
+
+    python -m bench.smtp_sink --port 2525 --latency-ms 20
+
+One thread per connection, so it keeps up with as many connections as Invite0 opens. Each
+message waits `--latency-ms` before being accepted, to stand in for a real server's processing
+time. No TLS or AUTH, so run Invite0 against it with MAIL_USE_TLS and MAIL_USERNAME unset.
+"""
+import argparse
+import socketserver
+import time
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self._reply('220 bench SMTP sink')
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command in (b'HELO', b'EHLO'):
+                self._reply('250 bench')
+            elif command == b'DATA':
+                self._reply('354 go ahead')
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                time.sleep(self.server.latency_ms / 1000)
+                self.server.message_cnt += 1  # close enough under the GIL
+                self._reply('250 queued')
+            elif command == b'QUIT':
+                self._reply('221 bye')
+                return
+            else:  # MAIL, RCPT, RSET, NOOP
+                self._reply('250 ok')
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 256
+
+
+def serve(port, latency_ms=0):
+    server = _Server(('127.0.0.1', port), _Handler)
+    server.latency_ms = latency_ms
+    server.message_cnt = 0
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    options = parser.parse_args()
+    serve(options.port, options.latency_ms)
+
+
+if __name__ == '__main__':
+    main()
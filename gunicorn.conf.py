@@ -0,0 +1,22 @@
+# gunicorn settings (see Dockerfile), mostly so that /metrics covers all the workers
+# http://docs.gunicorn.org/en/19.9.0/settings.html
+import os
+import shutil
+import tempfile
+
+bind = '0.0.0.0:8000'
+
+
+def on_starting(server):
+    # where each worker keeps its metrics (see invite0/metrics.py), fresh for each run so that
+    # metrics from previous runs don't linger. Set before the workers import prometheus_client.
+    os.environ['prometheus_multiproc_dir'] = tempfile.mkdtemp(prefix='invite0-metrics-')
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    shutil.rmtree(os.environ['prometheus_multiproc_dir'], ignore_errors=True)
@@ -1,10 +1,42 @@
 import logging
+import os
 
-from flask import Flask
+from invite0 import startup
+
+with startup.timed('flask'):
+    from flask import Flask
+    from jinja2 import FileSystemBytecodeCache
 
 app = Flask(__name__)
 app.logger.level = logging.INFO
-app.config.from_pyfile('config.py')
+with startup.timed('config'):
+    # rather than `from_pyfile`, which would run config.py again when it's imported elsewhere
+    app.config.from_object('invite0.config')
+    from invite0 import tenants
+    tenants.init_app(app)
+
+# keep compiled templates across restarts
+_jinja_cache_dir = os.path.join(app.config['DATA_DIR'], 'jinja-cache')
+os.makedirs(_jinja_cache_dir, exist_ok=True)
+app.jinja_options = {
+    **app.jinja_options,
+    'bytecode_cache': FileSystemBytecodeCache(_jinja_cache_dir),
+}
+
+# count rendering towards requests' timing breakdowns, see profiling.py
+from invite0 import profiling  # noqa
+app.jinja_env.template_class = profiling.TimedTemplate
 
 with app.app_context():
-    import invite0.views  # noqa
+    with startup.timed('views'):
+        import invite0.views  # noqa
+        import invite0.jobs
+    if app.config['WARM_UP']:
+        startup.warm_up(app)
+
+with startup.timed('workers'):
+    invite0.jobs.start_workers(app)
+    if app.config['AUTH0_USER_INDEX']:
+        from invite0.auth0 import user_index
+        user_index.start_syncer(app)
+startup.log_breakdown(app)
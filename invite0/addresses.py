@@ -0,0 +1,123 @@
+"""
+Reading and validating email addresses for bulk invites
+
+Addresses can be pasted into a textarea or uploaded as a CSV or plain text (one per line) file.
+Either way they're read a line at a time by generators, so a large roster is never held in memory
+as a whole, and all invalid addresses are counted rather than just the first. The first
+`MAX_INVALID_ROWS` are reported with their line numbers, which is plenty to go on for fixing a
+roster, without holding (or rendering) every row of one that's in the wrong format altogether.
+
+Addresses are normalized (see `normalize`) and deduplicated, so that eg `Foo@Example.com` and
+`foo@example.com` in a merged export get one invite rather than two.
+"""
+import codecs
+import csv
+import re
+from functools import lru_cache
+from typing import IO, Iterable, Iterator, List, Optional, Tuple
+
+
+_SEPARATORS = re.compile(r'[\s,]+')
+_EMAIL_HEADERS = {'email', 'e-mail', 'email address', 'e-mail address'}
+MAX_INVALID_ROWS = 50
+
+
+class InvalidAddressesError(Exception):
+    """Raised by `checked` once all the addresses have been read, if any were invalid"""
+
+    def __init__(self, rows: List[Tuple[int, str]], count: int):
+        super().__init__(f'{count} invalid email addresses')
+        self.rows = rows  # (line number, value), for the first `MAX_INVALID_ROWS` of them
+        self.count = count
+
+
+@lru_cache(maxsize=4096)
+def _normalize_domain(domain: str) -> Optional[str]:
+    # the expensive bit (IDNA), and there are far fewer distinct domains than addresses
+    from email_validator import validate_email_domain_part, EmailNotValidError  # slow to import
+    try:
+        return validate_email_domain_part(domain)['domain']
+    except EmailNotValidError:
+        return None
+
+
+def normalize(email_address: str) -> Optional[str]:
+    """
+    Return the canonical form of an email address, or None if it's invalid
+
+    The canonical form is trimmed and lowercased, with the domain in its IDNA (ASCII) form.
+    Strictly speaking the part before the @ is case-sensitive, but no mail server we'll
+    encounter treats it that way, and Auth0 lowercases it anyway.
+
+    Validation mimics `wtforms.validators.Email`:
+    https://github.com/wtforms/wtforms/blob/master/src/wtforms/validators.py#L384-L389
+    """
+    parts = email_address.strip().split('@')
+    if len(parts) != 2:
+        return None
+    local, domain = parts
+    domain = _normalize_domain(domain.lower())
+    if domain is None:
+        return None
+    from email_validator import validate_email_local_part, EmailNotValidError
+    try:
+        local = validate_email_local_part(local, allow_smtputf8=True, allow_empty_local=False)
+    except EmailNotValidError:
+        return None
+    return f"{local['local'].lower()}@{domain}"
+
+
+def from_text(text: str) -> Iterator[Tuple[int, str]]:
+    """Yield (line number, address) for addresses separated by commas and/or whitespace"""
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        for value in _SEPARATORS.split(line):
+            if value:
+                yield line_no, value
+
+
+def from_file(stream: IO[bytes]) -> Iterator[Tuple[int, str]]:
+    """
+    Yield (line number, address) for the addresses in an uploaded CSV or text file
+
+    If the first row is a header with an email column (eg "Email" or "Email Address"), only that
+    column is read, so exports from spreadsheets and other systems can be uploaded as they are.
+    Otherwise every non-empty cell is taken to be an address.
+
+    Raises `UnicodeDecodeError` or `csv.Error` if the file can't be read.
+    """
+    # `codecs` rather than `io.TextIOWrapper`, which needs more of the file API than uploads
+    # spooled to disk have
+    reader = csv.reader(codecs.getreader('utf-8-sig')(stream))
+    column = None
+    for row in reader:
+        if reader.line_num == 1:
+            headers = [cell.strip().lower() for cell in row]
+            column = next((i for i, h in enumerate(headers) if h in _EMAIL_HEADERS), None)
+            if column is not None:
+                continue
+        cells = row[column:column + 1] if column is not None else row
+        for cell in cells:
+            value = cell.strip()
+            if value:
+                yield reader.line_num, value
+
+
+def checked(rows: Iterable[Tuple[int, str]]) -> Iterator[str]:
+    """
+    Yield the normalized addresses in `rows`, skipping duplicates, then raise
+    `InvalidAddressesError` if there were any invalid ones
+    """
+    seen = set()
+    invalid_rows = []
+    invalid_count = 0
+    for line_no, value in rows:
+        email_address = normalize(value)
+        if email_address is None:
+            invalid_count += 1
+            if len(invalid_rows) < MAX_INVALID_ROWS:
+                invalid_rows.append((line_no, value))
+        elif email_address not in seen:
+            seen.add(email_address)
+            yield email_address
+    if invalid_count:
+        raise InvalidAddressesError(invalid_rows, invalid_count)
@@ -0,0 +1,236 @@
+"""
+Asyncio mode for bulk invite jobs (`BULK_INVITE_MODE=asyncio`)
+
+This is the same pipeline as `invite0.bulk`, except that the stages are coroutines on a single
+event loop thread per process rather than OS threads, so thousands of Auth0 lookups and SMTP
+sends can be in flight at once without thousands of threads. `BULK_INVITE_*_CONCURRENCY` may
+be set much higher in this mode.
+
+The views still use the sync clients.
+"""
+import asyncio
+import contextvars
+from threading import Lock, Thread
+from types import SimpleNamespace
+
+import aiosmtplib
+from flask import current_app as app
+from flask_mail import sanitize_address, sanitize_addresses
+
+import invite0.config as conf
+from invite0 import metrics
+import invite0.auth0.async_management_client as auth0_mgmt_async
+from invite0.auth0.admin import (
+    group_by_lowercase,
+    indexed_users_exist,
+    use_index,
+    search_query_chunks,
+    search_params,
+    is_last_page,
+)
+from invite0.bulk import _LOOKUP_BATCH_SIZE, _QUEUE_SIZE
+from invite0.mail import _mail, _invitation_message
+from invite0.tokens import generate_activation_token, generate_token
+
+
+_END = object()  # marks the end of a stage's input
+
+_self = SimpleNamespace(
+    lock=Lock(),
+    loop=None,
+)
+
+
+def _run_loop_forever(loop, app_obj):
+    asyncio.set_event_loop(loop)
+    # necessary in order for `app.logger` to work in the coroutines
+    with app_obj.app_context():
+        loop.run_forever()
+
+
+def _get_loop():
+    with _self.lock:
+        if _self.loop is None:
+            _self.loop = asyncio.new_event_loop()
+            Thread(
+                target=_run_loop_forever,
+                args=[_self.loop, app._get_current_object()],
+                name='asyncio-event-loop',
+                daemon=True,
+            ).start()
+    return _self.loop
+
+
+def run(coroutine):
+    """Run `coroutine` on this process's event loop thread, blocking until it's done"""
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop()).result()
+
+
+async def users_exist(email_addresses):
+    """Like `invite0.auth0.admin.users_exist`"""
+    by_lowercase = group_by_lowercase(email_addresses)
+    if use_index():
+        return indexed_users_exist(by_lowercase)  # a quick local lookup, fine to block on
+    existing = set()
+    for chunk in search_query_chunks(by_lowercase):
+        page_count = 0
+        while True:
+            response = await auth0_mgmt_async.get(
+                '/users', params=search_params(chunk, page_count)
+            )
+            page = response.json()
+            for user in page['users']:
+                existing.update(by_lowercase.get(user.get('email', '').lower(), []))
+            if is_last_page(page, page_count):
+                break
+            page_count += 1
+    return existing
+
+
+async def _smtp_connect():
+    if _mail().suppress:  # eg when testing
+        return None
+    smtp = aiosmtplib.SMTP(
+        hostname=conf.MAIL_SERVER,
+        port=int(conf.MAIL_PORT),
+        use_tls=conf.MAIL_USE_SSL,
+    )
+    with metrics.smtp_seconds.labels('connect').time():
+        await smtp.connect()
+        if conf.MAIL_USE_TLS:
+            await smtp.starttls()
+        if conf.MAIL_USERNAME and conf.MAIL_PASSWORD:
+            await smtp.login(conf.MAIL_USERNAME, conf.MAIL_PASSWORD)
+    return smtp
+
+
+async def _smtp_quit(smtp):
+    if smtp is None:
+        return
+    try:
+        await smtp.quit()
+    except (aiosmtplib.SMTPException, OSError):
+        smtp.close()
+
+
+class _SMTPConnection:
+    """An SMTP connection for one sender coroutine, reconnecting as `flask_mail`'s does"""
+
+    def __init__(self):
+        self.smtp = None
+        self.num_emails = 0
+
+    async def send(self, message):
+        if self.smtp is None and not _mail().suppress:
+            self.smtp = await _smtp_connect()
+        if self.smtp is not None:
+            args = (
+                sanitize_address(message.sender),
+                list(sanitize_addresses(message.send_to)),
+                message.as_bytes(),
+            )
+            try:
+                with metrics.smtp_seconds.labels('send').time():
+                    await self.smtp.sendmail(*args)
+            except aiosmtplib.SMTPServerDisconnected:
+                self.smtp = await _smtp_connect()
+                self.num_emails = 0
+                with metrics.smtp_seconds.labels('send').time():
+                    await self.smtp.sendmail(*args)
+        self.num_emails += 1
+        if self.num_emails == conf.MAIL_MAX_EMAILS:
+            await self.close()
+
+    async def close(self):
+        await _smtp_quit(self.smtp)
+        self.smtp = None
+        self.num_emails = 0
+
+
+async def _items(inbox):
+    while True:
+        item = await inbox.get()
+        if item is _END:
+            await inbox.put(_END)  # for the other workers in this stage
+            return
+        yield item
+
+
+async def _stage(concurrency, work, inbox, outbox):
+    """Run `concurrency` copies of `work(items)`, then tell the next stage its input has ended"""
+    await asyncio.gather(*(work(_items(inbox)) for _ in range(concurrency)))
+    if outbox is not None:
+        await outbox.put(_END)
+
+
+async def send_bulk_invites(email_addresses, checkpoint, provisioned=False):
+    """Like `invite0.bulk.send_bulk_invites`"""
+    loop = asyncio.get_event_loop()
+    batches = asyncio.Queue(maxsize=_QUEUE_SIZE)
+    to_link = asyncio.Queue(maxsize=_QUEUE_SIZE)
+    to_send = asyncio.Queue(maxsize=_QUEUE_SIZE)
+
+    async def mark(email_address, state):
+        # `checkpoint` writes to SQLite, which would block the loop. It's run in this context,
+        # ie the tenant's, rather than the executor thread's.
+        await loop.run_in_executor(None, contextvars.copy_context().run, checkpoint,
+                                   email_address, state)
+
+    async def feed():
+        for i in range(0, len(email_addresses), _LOOKUP_BATCH_SIZE):
+            await batches.put(email_addresses[i:i + _LOOKUP_BATCH_SIZE])
+        await batches.put(_END)
+
+    async def look_up(items):
+        async for batch in items:
+            existing = set() if provisioned else await users_exist(batch)
+            for email_address in batch:
+                if email_address in existing:
+                    await mark(email_address, 'skipped')
+                else:
+                    await to_link.put(email_address)
+
+    endpoint = 'activate' if provisioned else 'signup'
+    make_token = generate_activation_token if provisioned else generate_token
+    # rather than `url_for`, which would make links for the loop thread's app context, which
+    # isn't the tenant's if there are several (see `invite0.tenants`)
+    urls = app.url_map.bind(conf.SERVER_NAME, script_name=app.config['APPLICATION_ROOT'],
+                            url_scheme=app.config['PREFERRED_URL_SCHEME'])
+
+    async def make_links(items):
+        async for email_address in items:
+            token = make_token(email_address)
+            link = urls.build(endpoint, {'token': token}, force_external=True)
+            await to_send.put((email_address, link))
+
+    async def send(items):
+        conn = _SMTPConnection()
+        try:
+            async for email_address, link in items:
+                try:
+                    await conn.send(_invitation_message(email_address, link))
+                except aiosmtplib.SMTPRecipientsRefused:
+                    app.logger.warning(f'Mail server refused {email_address}')
+                    await mark(email_address, 'failed')
+                else:
+                    app.logger.info(f'Invitation sent to {email_address}')
+                    await mark(email_address, 'sent')
+        finally:
+            await conn.close()
+
+    tasks = [
+        asyncio.ensure_future(feed()),
+        asyncio.ensure_future(_stage(conf.BULK_INVITE_LOOKUP_CONCURRENCY, look_up,
+                                     batches, to_link)),
+        asyncio.ensure_future(_stage(conf.BULK_INVITE_LINK_CONCURRENCY, make_links,
+                                     to_link, to_send)),
+        asyncio.ensure_future(_stage(conf.BULK_INVITE_SEND_CONCURRENCY, send,
+                                     to_send, None)),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # eg Auth0 is down -- stop the other stages, which may be blocked on a full queue
+        for task in tasks:
+            task.cancel()
+        raise
@@ -1,21 +1,130 @@
+import json
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
 from flask import current_app as app
 
 from requests.exceptions import HTTPError
 
 import invite0.config as conf
 import invite0.auth0.management_client as auth0_mgmt
+from invite0 import tenants
+from invite0.auth0 import user_index
 from invite0.auth0.exceptions import (
     PasswordStrengthError,
     UserAlreadyExistsError,
     PasswordNoUserInfoError,
+    UserNotFoundError,
 )
 
+# Auth0 doesn't document a limit on the length of `q`, but very long URLs get rejected before
+# they reach the search engine. This keeps us well below any limit we've seen.
+_MAX_QUERY_LENGTH = 2000
+_SEARCH_PAGE_SIZE = 100  # Auth0's maximum
+# see: https://auth0.com/docs/users/bulk-user-imports#request-bulk-user-import
+_IMPORT_FILE_MAX_BYTES = 500 * 1000
+_TICKET_TTL = 60 * 60  # seconds; tickets are made as the user clicks through, so this is plenty
+
+
+def use_index() -> bool:
+    """Whether to look users up in the local index rather than ask Auth0 (see `user_index`)"""
+    return conf.AUTH0_USER_INDEX and user_index.is_fresh()
+
+
 def user_exists(email_address: str) -> bool:
     """Check if a user exists"""
+    if use_index():
+        return bool(user_index.existing([email_address.lower()]))
     user = auth0_mgmt.get('/users-by-email', params={'email': email_address}).json()
     return bool(user)
 
 
+# The building blocks of `users_exist`, shared with its async twin in `invite0.aio`
+
+def search_query_chunks(email_addresses: Iterable[str]) -> Iterator[List[str]]:
+    """Split `email_addresses` into lists that each fit in one user search query"""
+    chunk, length = [], 0
+    for email_address in email_addresses:
+        term_length = len(_quote(email_address)) + len(' OR ')
+        if chunk and length + term_length > _MAX_QUERY_LENGTH:
+            yield chunk
+            chunk, length = [], 0
+        chunk.append(email_address)
+        length += term_length
+    if chunk:
+        yield chunk
+
+
+def _quote(email_address: str) -> str:
+    escaped = email_address.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def group_by_lowercase(email_addresses: Iterable[str]) -> Dict[str, List[str]]:
+    """Map each of `email_addresses`, lowercased, to those that lowercase to it"""
+    by_lowercase = {}
+    for email_address in email_addresses:
+        by_lowercase.setdefault(email_address.lower(), []).append(email_address)
+    return by_lowercase
+
+
+def search_params(chunk: List[str], page_count: int) -> Dict:
+    """Query parameters for the `page_count`th page of a `/users` search for `chunk`"""
+    return {
+        'q': 'email:({})'.format(' OR '.join(_quote(email) for email in chunk)),
+        'search_engine': 'v3',
+        'fields': 'email',
+        'include_fields': 'true',
+        'per_page': _SEARCH_PAGE_SIZE,
+        'page': page_count,
+        'include_totals': 'true',
+    }
+
+
+def is_last_page(page: Dict, page_count: int) -> bool:
+    """Whether `page`, the `page_count`th page of a search, is its last"""
+    return (page_count + 1) * _SEARCH_PAGE_SIZE >= page['total']
+
+
+def indexed_users_exist(by_lowercase: Dict[str, List[str]]) -> Set[str]:
+    """`users_exist`, from the local index, for addresses grouped by `group_by_lowercase`"""
+    return {
+        email_address
+        for lowercase in user_index.existing(by_lowercase)
+        for email_address in by_lowercase[lowercase]
+    }
+
+
+def users_exist(email_addresses: Iterable[str]) -> Set[str]:
+    """
+    Check which of `email_addresses` belong to existing users
+
+    Rather than one `/users-by-email` request per address, many addresses are packed into each
+    `/users` search (`email:("a" OR "b" OR ...)`), so checking a bulk invite list costs a handful
+    of requests instead of one per address.
+
+    Auth0 stores email addresses lowercased, so matching is case-insensitive.
+    See: https://auth0.com/docs/users/user-search/user-search-query-syntax
+
+    With `AUTH0_USER_INDEX`, Auth0 isn't asked at all (see `user_index`).
+
+    :return: the subset of `email_addresses` for which a user exists
+    """
+    by_lowercase = group_by_lowercase(email_addresses)
+    if use_index():
+        return indexed_users_exist(by_lowercase)
+    existing = set()
+    for chunk in search_query_chunks(by_lowercase):
+        page_count = 0
+        while True:
+            page = auth0_mgmt.get('/users', params=search_params(chunk, page_count)).json()
+            for user in page['users']:
+                existing.update(by_lowercase.get(user.get('email', '').lower(), []))
+            if is_last_page(page, page_count):
+                break
+            page_count += 1
+    return existing
+
+
 def create_user(email_address: str, password: str, **extras):
     """Create a new user"""
     response = auth0_mgmt.post(
@@ -37,8 +146,103 @@ def create_user(email_address: str, password: str, **extras):
         elif response.json()['message'].startswith('PasswordNoUserInfoError'):
             raise PasswordNoUserInfoError
         elif response.status_code == 409:
+            if conf.AUTH0_USER_INDEX:
+                user_index.add(email_address)
             raise UserAlreadyExistsError
         else:
             app.logger.exception(f'Failed to create account for {email_address}.')
             raise e   # to be caught by caller
+    if conf.AUTH0_USER_INDEX:
+        user_index.add(email_address)
     app.logger.info(f'Created user {email_address}!')
+
+
+def _fetch_connection_id() -> str:
+    connections = auth0_mgmt.get('/connections', params={
+        'name': 'Username-Password-Authentication',
+        'fields': 'id',
+    }).json()
+    return connections[0]['id']
+
+
+def _connection_id() -> str:
+    """ID of the database connection users are created in, which some endpoints want by ID"""
+    return tenants.resource('auth0_connection_id', _fetch_connection_id)
+
+
+def import_users(email_addresses: List[str]) -> Tuple[str, int]:
+    """
+    Start a job creating users for as many of `email_addresses` as fit in one import file
+
+    The users get no password (see `password_change_ticket`), and their email addresses are
+    marked as verified, since that's where their invitations go. Existing users are left alone,
+    and reported as such by `user_import_results`.
+    See: https://auth0.com/docs/users/bulk-user-imports
+
+    :return: the import job's ID, and how many of `email_addresses` (from the start) it covers
+    """
+    users, size = [], len('[]')
+    for email_address in email_addresses:
+        user = json.dumps({'email': email_address, 'email_verified': True})  # ASCII
+        if size + len(user) + len(',') > _IMPORT_FILE_MAX_BYTES:
+            break
+        users.append(user)
+        size += len(user) + len(',')
+    job = auth0_mgmt.post(
+        '/jobs/users-imports',
+        files={'users': ('users.json', f"[{','.join(users)}]".encode(), 'application/json')},
+        data={
+            'connection_id': _connection_id(),
+            'upsert': 'false',
+            'send_completion_email': 'false',
+        },
+    ).json()
+    return job['id'], len(users)
+
+
+def user_import_results(job_id: str) -> Optional[Tuple[Set[str], Set[str]]]:
+    """
+    Check on a job started by `import_users`
+
+    :return: None if it's still running, otherwise (existing, failed): the email addresses
+      that already belonged to a user, and those that couldn't be imported for other reasons
+    :raise: RuntimeError if the job as a whole failed
+    """
+    job = auth0_mgmt.get(f'/jobs/{job_id}').json()
+    if job['status'] in ('pending', 'processing'):
+        return None
+    if job['status'] != 'completed':
+        raise RuntimeError(f"User import {job_id} {job['status']}")
+    existing, failed = set(), set()
+    response = auth0_mgmt.get(f'/jobs/{job_id}/errors')
+    if response.status_code == 204:  # no errors
+        return existing, failed
+    for user_errors in response.json():
+        email_address = user_errors['user'].get('email', '').lower()
+        codes = {error['code'] for error in user_errors['errors']}
+        if codes == {'DUPLICATED_USER'}:
+            existing.add(email_address)
+        else:
+            app.logger.warning(f'Failed to import user {email_address}: {user_errors["errors"]}')
+            failed.add(email_address)
+    return existing, failed
+
+
+def password_change_ticket(email_address: str, result_url: str) -> str:
+    """
+    Return a link to Auth0's page for setting a password, eg for a user made by `import_users`
+
+    :param result_url: where to send the user once they've set a password
+    :raise UserNotFoundError: if there's no such user, eg it's been deleted since
+    """
+    response = auth0_mgmt.post('/tickets/password-change', json={
+        'email': email_address,
+        'connection_id': _connection_id(),
+        'result_url': result_url,
+        'ttl_sec': _TICKET_TTL,
+        'mark_email_as_verified': True,
+    }, raise_for_status=False)
+    if response.status_code == 404:
+        raise UserNotFoundError
+    response.raise_for_status()
+    return response.json()['ticket']
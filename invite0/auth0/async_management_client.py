@@ -0,0 +1,126 @@
+"""
+Asyncio versions of `management_client`'s `get`, `post`, and `patch`
+
+These share the sync client's access token, rate limiter, retry policy, circuit breaker, and
+cache invalidation, so the two can be used side by side. They're meant to be called from the
+event loop in `invite0.aio`, where a single thread can have thousands of requests in flight.
+"""
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import aiohttp
+from flask import current_app as app
+
+import invite0.config as conf
+from invite0 import metrics, tenants
+import invite0.auth0.management_client as auth0_mgmt
+
+
+def _close_session(client):
+    if client.session is not None:
+        asyncio.run_coroutine_threadsafe(client.session.close(), client.loop)
+
+
+# the current tenant's
+_self = tenants.local('auth0_mgmt_async', lambda: SimpleNamespace(
+    session=None,  # aiohttp.ClientSession, created on the event loop
+    loop=None,  # that loop
+), close=_close_session)
+
+
+class Response:
+    """The bits of `requests.Response` that we use"""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def _session() -> aiohttp.ClientSession:
+    if _self.session is None:
+        connect_timeout, read_timeout = auth0_mgmt._TIMEOUT
+        _self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=conf.AUTH0_MGMT_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout),
+        )
+        _self.loop = asyncio.get_event_loop()
+    return _self.session
+
+
+async def _access_token() -> str:
+    if auth0_mgmt._token_expires_within(auth0_mgmt._EXPIRATION_BUFFER):
+        # rare (the sync client refreshes the token in the background) so just block a thread
+        app_obj = app._get_current_object()
+        tenant = tenants.current()
+
+        def fetch():
+            with tenants.use(tenant), app_obj.app_context():
+                return auth0_mgmt._access_token()
+
+        return await asyncio.get_event_loop().run_in_executor(None, fetch)
+    return auth0_mgmt._self.token[0]
+
+
+async def _request(method, resource, raise_for_status=True, headers=None, **kwargs) -> Response:
+    url = f'https://{conf.AUTH0_DOMAIN}/api/v2{resource}'
+    attempt = 0
+    while True:
+        attempt += 1
+        auth0_mgmt._check_breaker()
+        request_headers = {**(headers or {}), 'Authorization': f'Bearer {await _access_token()}'}
+
+        wait = auth0_mgmt._reserve_request_slot()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        started_at = time.perf_counter()
+        try:
+            async with _session().request(method, url, headers=request_headers,
+                                          **kwargs) as response:
+                content = await response.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            auth0_mgmt._record_outcome(failed=True)
+            delay = auth0_mgmt._retry_delay(method, attempt)
+            if delay is None:
+                raise
+        else:
+            metrics.auth0_mgmt_request_seconds.labels(
+                method, metrics.resource_label(resource), response.status
+            ).observe(time.perf_counter() - started_at)
+            auth0_mgmt._update_rate_limit(response.headers, response.status)
+            is_transient_failure = auth0_mgmt._is_transient_failure(response.status)
+            auth0_mgmt._record_outcome(failed=is_transient_failure)
+            delay = None
+            if response.status == 429 or is_transient_failure:
+                delay = auth0_mgmt._retry_delay(method, attempt, response.status, response.headers)
+            if delay is None:
+                if raise_for_status:
+                    response.raise_for_status()
+                return Response(response.status, response.headers, content)
+        app.logger.warning(f'Management API request failed: {method} {resource}, '
+                           f'retrying in {delay:.1f}s.')
+        await asyncio.sleep(delay)
+
+
+async def get(resource, **kwargs) -> Response:
+    return await _request('GET', resource, **kwargs)
+
+
+async def post(resource, **kwargs) -> Response:
+    try:
+        return await _request('POST', resource, **kwargs)
+    finally:
+        auth0_mgmt._invalidate(resource)
+
+
+async def patch(resource, **kwargs) -> Response:
+    try:
+        return await _request('PATCH', resource, **kwargs)
+    finally:
+        auth0_mgmt._invalidate(resource)
@@ -10,6 +10,10 @@ class PasswordNoUserInfoError(Exception):
     pass
 
 
+class UserNotFoundError(Exception):
+    pass
+
+
 class UserNotLoggedIn(Exception):
     pass
 
@@ -17,3 +21,6 @@ class UserNotLoggedIn(Exception):
 class CanNotUnsetFieldError(Exception):
     pass
 
+
+class Auth0UnavailableError(Exception):
+    """Auth0 has been failing, so we're not sending it requests for a while"""
@@ -0,0 +1,74 @@
+"""
+Local verification of access tokens issued by our Auth0 tenant
+
+The tenant's public signing keys (its JWKS) are cached for `AUTH0_JWKS_REFRESH_SECONDS`, and
+refetched early if a token turns up signed with a key we haven't seen, ie after a key rotation.
+See: https://auth0.com/docs/tokens/json-web-tokens/json-web-key-sets
+"""
+import time
+from functools import lru_cache
+from threading import Lock
+from types import SimpleNamespace
+
+import requests
+
+import invite0.config as conf
+from invite0 import tenants
+
+
+@lru_cache(maxsize=None)
+def _jwt():
+    from authlib.jose import JsonWebToken  # slow to import, so not until we need it
+    return JsonWebToken(['RS256'])  # what Auth0 signs access tokens with, and nothing else
+
+
+# the current tenant's
+_self = tenants.local('jwks', lambda: SimpleNamespace(
+    lock=Lock(),
+    keys={},  # kid -> JWK
+    fetched_at=None,
+))
+
+
+def _fetch_jwks():
+    response = requests.get(f'https://{conf.AUTH0_DOMAIN}/.well-known/jwks.json', timeout=10)
+    response.raise_for_status()
+    _self.keys = {key['kid']: key for key in response.json()['keys']}
+    _self.fetched_at = time.monotonic()
+
+
+def fetch_keys():
+    """Fetch the JWKS now rather than when the first token needs verifying, eg to warm up"""
+    with _self.lock:
+        _fetch_jwks()
+
+
+def _get_key(header, payload):
+    kid = header.get('kid')
+    with _self.lock:
+        is_stale = (
+            _self.fetched_at is None
+            or time.monotonic() - _self.fetched_at > conf.AUTH0_JWKS_REFRESH_SECONDS
+        )
+        if is_stale or kid not in _self.keys:
+            _fetch_jwks()
+        try:
+            return _self.keys[kid]
+        except KeyError:
+            raise ValueError(f'Unknown signing key: {kid}')
+
+
+def verify_access_token(access_token: str):
+    """
+    Verify signature, issuer, audience, and expiration of an access token
+
+    :return: the token's claims
+    :raise: `authlib.jose.errors.JoseError` or `ValueError` if the token is invalid
+    """
+    claims = _jwt().decode(access_token, _get_key, claims_options={
+        'iss': {'essential': True, 'value': f'https://{conf.AUTH0_DOMAIN}/'},
+        'aud': {'essential': True, 'value': conf.AUTH0_AUDIENCE},
+        'exp': {'essential': True},
+    })
+    claims.validate(leeway=60)
+    return claims
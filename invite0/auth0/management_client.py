@@ -5,65 +5,458 @@ The public functions (`get`, `post`, and `patch`) may be used as
 normal, except that the following is handled automatically:
 - base url
 - authentication on first request
-- re-authentication if token has expired
+- re-authentication before the token expires (in a background thread)
+- sharing the token with other processes (optional, see `token_store`)
+- thread (and greenlet) safety, connection pooling, and a cap on concurrent requests
+- rate limiting
+- retries of rate-limited and transiently failed requests, and failing fast (with
+  `Auth0UnavailableError`) while Auth0 is down
+- caching of GET responses (optional, see `_CACHE_TTLS`)
+- a separate session, token, rate limit, etc for each tenant (see `invite0.tenants`)
 
 Some might implement this as a class, but this would be misguided imo because
 we only want one instance and do not need inheritance. That said, this approach
 does have drawbacks for testing, and if we're ever to add support for other IdPs
 then we'll probably want inheritance.
 """
-from datetime import datetime, timedelta
+import random
+import re
+import time
+from collections import OrderedDict
+from threading import Event, Lock, Thread
 from types import SimpleNamespace
 
 from flask import current_app as app
+from flask import g, has_request_context
 from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
 
 import invite0.config as conf
+from invite0 import data, metrics, profiling, tenants
+from invite0.auth0 import token_store
+from invite0.auth0.exceptions import Auth0UnavailableError
 
 
-_self = SimpleNamespace(
-    session=Session(),
-    token_expiration_time=None
+_EXPIRATION_BUFFER = 30  # seconds; play it safe
+_REFRESH_MARGIN = 0.1  # renew tokens once 90% of their lifetime has passed
+_REFRESH_RETRY_INTERVAL = 30  # seconds
+_TIMEOUT = (5, 30)  # seconds to connect, and to wait for each chunk of the response
+
+
+def _new_session() -> Session:
+    # A requests `Session` is safe to share between threads as long as nobody mutates it, which
+    # is why the access token is passed per request rather than set in `session.headers`.
+    # Connections are kept alive and reused. No more than `AUTH0_MGMT_POOL_SIZE` requests are
+    # in flight at once -- the rest wait for a connection -- which matters under gevent, where
+    # there may be hundreds of greenlets making requests.
+    session = Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=conf.AUTH0_MGMT_POOL_SIZE,
+        pool_block=True,
+    )
+    session.mount('https://', adapter)
+    return session
+
+
+def _close_client(client):
+    client.closed.set()  # stops the refresher
+    client.session.close()
+
+
+# the current tenant's
+_self = tenants.local('auth0_mgmt', lambda: SimpleNamespace(
+    session=_new_session(),
+    auth_lock=Lock(),
+    token=None,  # (access token, expiration time, time to refresh)
+    refresher=None,  # Thread
+    closed=Event(),  # set if the tenant's been idle long enough for this to be dropped
+), close=_close_client)
+
+
+# Token bucket shared by every thread in the process (bulk invite jobs, views, session lookups),
+# so that together they stay within the tenant's Management API quota. `tokens` may go negative:
+# each caller reserves a token and then waits for the bucket to refill up to it, which queues
+# callers fairly without them having to poll.
+def _new_rate_limit():
+    tier_limits = data.MGMT_API_RATE_LIMITS[conf.AUTH0_TIER]
+    return SimpleNamespace(
+        lock=Lock(),
+        rate=conf.AUTH0_MGMT_API_RATE_LIMIT or tier_limits['rate'],  # tokens/second
+        capacity=conf.AUTH0_MGMT_API_BURST or tier_limits['burst'],
+        tokens=conf.AUTH0_MGMT_API_BURST or tier_limits['burst'],
+        last_refill=time.monotonic(),  # may be in the future if Auth0 told us to back off
+    )
+
+
+_rate_limit = tenants.local('auth0_mgmt_rate_limit', _new_rate_limit)
+
+
+def _reserve_request_slot() -> float:
+    """Take a token from the bucket and return how many seconds to wait before using it"""
+    with _rate_limit.lock:
+        now = time.monotonic()
+        elapsed = max(0.0, now - _rate_limit.last_refill)
+        _rate_limit.tokens = min(
+            _rate_limit.capacity,
+            _rate_limit.tokens + elapsed * _rate_limit.rate
+        )
+        _rate_limit.last_refill = max(now, _rate_limit.last_refill)
+        _rate_limit.tokens -= 1
+        deficit = max(0.0, -_rate_limit.tokens)
+        return (_rate_limit.last_refill - now) + deficit / _rate_limit.rate
+
+
+def _update_rate_limit(headers, status_code):
+    """
+    Reconcile the bucket with Auth0's view of it
+
+    Auth0 reports the bucket size, the requests remaining in it, and (as a UTC epoch timestamp)
+    when it will be refilled. Other processes, or other apps using the same tenant, draw from the
+    same bucket, so Auth0's count is authoritative whenever it is lower than ours.
+    See: https://auth0.com/docs/policies/rate-limit-policy#exceeding-the-rate-limit
+    """
+    try:
+        limit = int(headers['X-RateLimit-Limit'])
+        remaining = int(headers['X-RateLimit-Remaining'])
+        reset = int(headers['X-RateLimit-Reset'])
+    except (KeyError, ValueError):
+        return
+    metrics.auth0_mgmt_rate_limit_remaining.set(remaining)
+    with _rate_limit.lock:
+        _rate_limit.capacity = limit
+        _rate_limit.tokens = min(_rate_limit.tokens, remaining)
+        if remaining == 0 or status_code == 429:
+            # no refill until the reset time
+            now = time.monotonic()
+            until_reset = max(0.0, reset - time.time())
+            _rate_limit.tokens = min(_rate_limit.tokens, 0)
+            _rate_limit.last_refill = max(_rate_limit.last_refill, now + until_reset)
+
+
+# Retries. Rate-limited requests (429) weren't processed, so they can be retried whatever the
+# method. Otherwise only idempotent requests are retried, eg not a POST that timed out, which may
+# have created a user.
+_MAX_ATTEMPTS = 5
+_BACKOFF_BASE = 0.5  # seconds, doubled for each retry, with full jitter
+_BACKOFF_MAX = 30  # seconds
+_MAX_RETRY_WAIT = 60  # seconds; if Auth0 asks us to wait longer than this, give up instead
+_IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE'}
+_TRANSIENT_STATUSES = {500, 502, 503, 504}
+
+# Circuit breaker: after `_BREAKER_THRESHOLD` transient failures in a row (counting retries),
+# requests fail straight away for `_BREAKER_COOLDOWN` seconds, rather than every thread spending
+# minutes retrying against a tenant that's down. Then a single request is let through to see if
+# Auth0 is back.
+_BREAKER_THRESHOLD = 5
+_BREAKER_COOLDOWN = 30  # seconds
+_breaker = tenants.local('auth0_mgmt_breaker', lambda: SimpleNamespace(
+    lock=Lock(),
+    failures=0,  # in a row
+    open_until=0.0,  # monotonic time
+))
+
+
+def _check_breaker():
+    """Raise `Auth0UnavailableError` if the breaker is open"""
+    with _breaker.lock:
+        if _breaker.failures < _BREAKER_THRESHOLD:
+            return
+        now = time.monotonic()
+        if now < _breaker.open_until:
+            raise Auth0UnavailableError
+        # let this request through to see if Auth0 is back, but hold off the rest meanwhile
+        _breaker.open_until = now + _BREAKER_COOLDOWN
+
+
+def _record_outcome(failed: bool):
+    with _breaker.lock:
+        if not failed:
+            _breaker.failures = 0
+            return
+        _breaker.failures += 1
+        if _breaker.failures >= _BREAKER_THRESHOLD:
+            _breaker.open_until = time.monotonic() + _BREAKER_COOLDOWN
+            if _breaker.failures == _BREAKER_THRESHOLD:
+                app.logger.error('Auth0 Management API is failing, pausing requests.')
+
+
+def _is_transient_failure(status_code) -> bool:
+    """`status_code` is None if there was no response at all, eg a timeout"""
+    return status_code is None or status_code in _TRANSIENT_STATUSES
+
+
+def _retry_delay(method, attempt, status_code=None, headers=None):
+    """
+    Seconds to wait before retrying a failed request, or None if it shouldn't be retried
+
+    :param attempt: number of attempts so far, starting from 1
+    :param status_code: None if there was no response
+    """
+    if attempt >= _MAX_ATTEMPTS:
+        return None
+    if status_code != 429 and (
+        method not in _IDEMPOTENT_METHODS or not _is_transient_failure(status_code)
+    ):
+        return None
+    delay = random.uniform(0, min(_BACKOFF_MAX, _BACKOFF_BASE * 2 ** (attempt - 1)))
+    # the rate limiter is already waiting for X-RateLimit-Reset (see `_update_rate_limit`), but
+    # if it's far off, we'd rather fail than tie up the thread
+    wait_for = []
+    if headers and headers.get('Retry-After', '').isdigit():
+        wait_for.append(int(headers['Retry-After']))
+    if status_code == 429 and headers and headers.get('X-RateLimit-Reset', '').isdigit():
+        wait_for.append(int(headers['X-RateLimit-Reset']) - time.time())
+    if wait_for:
+        if max(wait_for) > _MAX_RETRY_WAIT:
+            return None
+        delay += max(0, *wait_for)
+    return delay
+
+
+# How long (seconds) a GET response may be reused, by resource. Resources not listed are never
+# cached. Responses are always reused within a single request (see `_request_memo`), and across
+# requests too if `AUTH0_MGMT_CACHE` is enabled.
+_CACHE_TTLS = (
+    (re.compile(r'^/users/[^/]+$'), 300),
+    (re.compile(r'^/users/[^/]+/permissions$'), 60),
+    (re.compile(r'^/users-by-email$'), 60),
 )
 
-def _authenticate():
-    response = _self.session.post(f'https://{conf.AUTH0_DOMAIN}/oauth/token', data=dict(
-        client_id=conf.AUTH0_CLIENT_ID,
-        client_secret=conf.AUTH0_CLIENT_SECRET,
-        audience=f'https://{conf.AUTH0_DOMAIN}/api/v2/',
-        grant_type='client_credentials',
-    ))
+# LRU cache of (fetched_at, expires_at, response), keyed by (resource, params)
+_cache = tenants.local('auth0_mgmt_cache', lambda: SimpleNamespace(
+    lock=Lock(),
+    entries=OrderedDict(),
+    size=0,  # bytes
+))
+
+
+def _cache_ttl(resource):
+    for pattern, ttl in _CACHE_TTLS:
+        if pattern.match(resource):
+            return ttl
+    return None
+
+
+def _cache_key(resource, params):
+    return resource, tuple(sorted((params or {}).items()))
+
+
+def _cache_get(key, fresh_after):
+    with _cache.lock:
+        entry = _cache.entries.get(key)
+        if entry is None:
+            return None
+        fetched_at, expires_at, response = entry
+        if time.time() > expires_at or (fresh_after and fetched_at < fresh_after):
+            _cache_drop(key)
+            return None
+        _cache.entries.move_to_end(key)
+        return response
+
+
+def _cache_put(key, response, ttl):
+    now = time.time()
+    with _cache.lock:
+        if key in _cache.entries:
+            _cache_drop(key)
+        _cache.entries[key] = (now, now + ttl, response)
+        _cache.size += len(response.content)
+        while _cache.size > conf.AUTH0_MGMT_CACHE_MAX_BYTES and _cache.entries:
+            _cache_drop(next(iter(_cache.entries)))
+
+
+def _cache_drop(key):
+    """Remove an entry. Caller must hold `_cache.lock`."""
+    _, _, response = _cache.entries.pop(key)
+    _cache.size -= len(response.content)
+
+
+def _request_memo():
+    """Responses already fetched during the current request, or None outside of one"""
+    if not has_request_context():
+        return None
+    return g.setdefault('_auth0_mgmt_memo', {})
+
+
+def _invalidate(resource):
+    """Forget cached responses that a write to `resource` may have made stale"""
+    prefixes = [resource]
+    if resource.startswith('/users/'):
+        prefixes.append('/users-by-email')  # in case the email address changed
+
+    def is_stale(key):
+        return any(key[0].startswith(prefix) for prefix in prefixes)
+
+    memo = _request_memo()
+    if memo:
+        for key in [key for key in memo if is_stale(key)]:
+            del memo[key]
+    with _cache.lock:
+        for key in [key for key in _cache.entries if is_stale(key)]:
+            _cache_drop(key)
+
+
+def _fetch_token():
+    with metrics.auth0_oauth_seconds.labels('client_credentials').time():
+        response = _self.session.post(f'https://{conf.AUTH0_DOMAIN}/oauth/token', data=dict(
+            client_id=conf.AUTH0_CLIENT_ID,
+            client_secret=conf.AUTH0_CLIENT_SECRET,
+            audience=f'https://{conf.AUTH0_DOMAIN}/api/v2/',
+            grant_type='client_credentials',
+        ))
     response.raise_for_status()
     response = response.json()
-    _self.token_expiration_time = datetime.now() + timedelta(seconds=response['expires_in'])
-    _self.session.headers['Authorization'] = 'Bearer {}'.format(response['access_token'])
+    now = time.time()
     app.logger.info('Obtained access token for Management API.')
+    return (
+        response['access_token'],
+        now + response['expires_in'],
+        now + response['expires_in'] * (1 - _REFRESH_MARGIN),
+    )
+
+
+def _authenticate():
+    """Get a new access token. Caller must hold `_self.auth_lock`."""
+    # `_self.token` is replaced in one go so that readers never see a token paired with
+    # another's expiration
+    if not conf.AUTH0_MGMT_TOKEN_DIR:
+        _self.token = _fetch_token()
+    else:
+        with token_store.locked():
+            # another process may have already fetched one
+            token = token_store.read()
+            if token is None or time.time() >= token[2]:
+                token = _fetch_token()
+                token_store.write(token)
+            _self.token = token
+    metrics.auth0_mgmt_token_obtained.set_to_current_time()
+
+
+def _token_expires_within(seconds) -> bool:
+    return _self.token is None or time.time() > _self.token[1] - seconds
+
+
+def _access_token() -> str:
+    """
+    Return a valid access token, fetching one if necessary
 
+    Normally the refresher thread renews the token well before it expires, so this doesn't
+    block. Otherwise, only one thread fetches a token and the rest wait for it.
+    """
+    if _token_expires_within(_EXPIRATION_BUFFER):
+        with _self.auth_lock:
+            if _token_expires_within(_EXPIRATION_BUFFER):  # maybe another thread beat us to it
+                _authenticate()
+            _start_refresher()
+    return _self.token[0]
 
-def _token_has_expired() -> bool:
-    buffer_ = timedelta(seconds=30)  # play it safe
-    return datetime.now() > _self.token_expiration_time - buffer_
 
+def _start_refresher():
+    """Start the token refresher thread, if not already running. Caller must hold `auth_lock`."""
+    if _self.refresher is None or not _self.refresher.is_alive():
+        _self.refresher = Thread(
+            target=_refresh_token_forever,
+            args=[app._get_current_object(), tenants.current(), _self._get_current_object()],
+            name='auth0-token-refresher',
+            daemon=True,
+        )
+        _self.refresher.start()
 
-def _request(method, resource, raise_for_status=True, **kwargs):
-    is_first_request = _self.token_expiration_time is None
-    if is_first_request or _token_has_expired():
-        _authenticate()
 
+def _refresh_token_forever(app_obj, tenant, client):
+    """Renew the access token once it's due, ie well before it expires, until `client` closes"""
+    with app_obj.app_context():
+        while True:
+            _, _, refresh_at = client.token
+            if client.closed.wait(max(0.0, refresh_at - time.time())):
+                return
+            try:
+                with tenants.use(tenant), client.auth_lock:
+                    if client.closed.is_set():
+                        return
+                    if time.time() >= client.token[2]:  # else someone else already did
+                        _authenticate()
+            except Exception:
+                app.logger.exception('Failed to refresh Management API token, will retry.')
+                if client.closed.wait(_REFRESH_RETRY_INTERVAL):
+                    return
+
+
+@profiling.spanned('auth0')
+def _request(method, resource, raise_for_status=True, headers=None, **kwargs):
+    kwargs.setdefault('timeout', _TIMEOUT)
     url = f'https://{conf.AUTH0_DOMAIN}/api/v2{resource}'
-    response = _self.session.request(method, url, **kwargs)
-    if raise_for_status:
-        response.raise_for_status()
-    return response
+    attempt = 0
+    while True:
+        attempt += 1
+        _check_breaker()
+        request_headers = {**(headers or {}), 'Authorization': f'Bearer {_access_token()}'}
+
+        wait = _reserve_request_slot()
+        if wait > 0:
+            time.sleep(wait)
 
+        started_at = time.perf_counter()
+        try:
+            response = _self.session.request(method, url, headers=request_headers, **kwargs)
+        except (ConnectionError, Timeout):
+            _record_outcome(failed=True)
+            delay = _retry_delay(method, attempt)
+            if delay is None:
+                raise
+        else:
+            metrics.auth0_mgmt_request_seconds.labels(
+                method, metrics.resource_label(resource), response.status_code
+            ).observe(time.perf_counter() - started_at)
+            _update_rate_limit(response.headers, response.status_code)
+            _record_outcome(failed=_is_transient_failure(response.status_code))
+            delay = None
+            if response.status_code == 429 or _is_transient_failure(response.status_code):
+                delay = _retry_delay(method, attempt, response.status_code, response.headers)
+            if delay is None:
+                if raise_for_status:
+                    response.raise_for_status()
+                return response
+        app.logger.warning(f'Management API request failed: {method} {resource}, '
+                           f'retrying in {delay:.1f}s.')
+        time.sleep(delay)
 
-def get(resource, **kwargs):
-    return _request('GET', resource, **kwargs)
+
+def get(resource, fresh_after=None, **kwargs):
+    """
+    :param fresh_after: ignore cached responses fetched before this time (epoch seconds).
+      Writes only invalidate the cache of the process that made them, so callers that know of a
+      write made elsewhere (eg by another gunicorn worker) can use this to skip stale entries.
+    """
+    ttl = _cache_ttl(resource)
+    if ttl is None or set(kwargs) - {'params'}:
+        return _request('GET', resource, **kwargs)
+
+    key = _cache_key(resource, kwargs.get('params'))
+    memo = _request_memo()
+    if memo is not None and key in memo:
+        return memo[key]
+    response = _cache_get(key, fresh_after) if conf.AUTH0_MGMT_CACHE else None
+    if response is None:
+        response = _request('GET', resource, **kwargs)
+        if conf.AUTH0_MGMT_CACHE and response.status_code == 200:
+            _cache_put(key, response, ttl)
+    if memo is not None:
+        memo[key] = response
+    return response
 
 
 def post(resource, **kwargs):
-    return _request('POST', resource, **kwargs)
+    try:
+        return _request('POST', resource, **kwargs)
+    finally:
+        _invalidate(resource)
 
 
 def patch(resource, **kwargs):
-    return _request('PATCH', resource, **kwargs)
+    try:
+        return _request('PATCH', resource, **kwargs)
+    finally:
+        _invalidate(resource)
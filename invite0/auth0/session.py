@@ -1,27 +1,43 @@
+import time
 from functools import wraps
+from threading import BoundedSemaphore
 from urllib.parse import urlencode
 from typing import List, Dict
 
 import requests
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, RequestException
 
 from flask import session, redirect, url_for, request, render_template
 from flask import current_app as app
-from authlib.integrations.flask_client import OAuth
 
 import invite0.config as conf
 import invite0.auth0.management_client as auth0_mgmt
+from invite0 import metrics, profiling, tenants
+from invite0.auth0.jwks import verify_access_token
 from invite0.auth0.exceptions import UserNotLoggedIn, CanNotUnsetFieldError
 
-_oauth_client = OAuth(app).register(
-    'auth0',
-    client_id=conf.AUTH0_CLIENT_ID,
-    client_secret=conf.AUTH0_CLIENT_SECRET,
-    api_base_url=f'https://{conf.AUTH0_DOMAIN}',
-    access_token_url=f'https://{conf.AUTH0_DOMAIN}/oauth/token',
-    authorize_url=f'https://{conf.AUTH0_DOMAIN}/authorize',
-    client_kwargs={'scope': 'openid profile email'},
-)
+
+def _new_oauth_client():
+    # made on first use, as authlib is slow to import and only needed for logging in
+    from authlib.integrations.flask_client import OAuth
+    return OAuth(app._get_current_object()).register(
+        'auth0',
+        client_id=conf.AUTH0_CLIENT_ID,
+        client_secret=conf.AUTH0_CLIENT_SECRET,
+        api_base_url=f'https://{conf.AUTH0_DOMAIN}',
+        access_token_url=f'https://{conf.AUTH0_DOMAIN}/oauth/token',
+        authorize_url=f'https://{conf.AUTH0_DOMAIN}/authorize',
+        client_kwargs={'scope': 'openid profile email'},
+    )
+
+
+def _oauth_client():
+    """The current tenant's"""
+    return tenants.resource('oauth', _new_oauth_client)
+
+
+# caps concurrent requests to the Authentication API (see `invite0.concurrency`)
+_auth_api_slots = BoundedSemaphore(conf.AUTH0_AUTH_POOL_SIZE)
 
 
 class _CurrentUser:
@@ -45,6 +61,8 @@ class _CurrentUser:
     """
 
     id_cookie = 'user_id'
+    profile_updated_cookie = 'profile_updated_at'
+    permissions_cookie = 'permissions'
 
     @property
     def user_id(self):
@@ -58,14 +76,20 @@ class _CurrentUser:
         return self.id_cookie in session
 
     def log_in(self, user_id: str):
+        session.pop(self.permissions_cookie, None)
         session[self.id_cookie] = user_id
 
     def log_out(self):
+        session.pop(self.permissions_cookie, None)
         del session[self.id_cookie]
 
     @property
     def profile(self) -> Dict:
-        return auth0_mgmt.get(f'/users/{self.user_id}').json()
+        # the profile may have been cached by a worker other than the one that updated it
+        return auth0_mgmt.get(
+            f'/users/{self.user_id}',
+            fresh_after=session.get(self.profile_updated_cookie)
+        ).json()
 
     @profile.setter
     def profile(self, data):
@@ -74,6 +98,7 @@ class _CurrentUser:
             data=data,
             raise_for_status=False
         )
+        session[self.profile_updated_cookie] = time.time()
         try:
             response.raise_for_status()
         except HTTPError as e:
@@ -83,9 +108,35 @@ class _CurrentUser:
                 # TODO: Why doesn't Auth0 allow this? Is there a way around it?
                 raise CanNotUnsetFieldError
 
+    def store_token_permissions(self, access_token: str):
+        """
+        Verify `access_token` and keep its `permissions` claim in the session
+
+        Until the token expires, `permissions` is then answered from the session rather than
+        the Management API. If the token can't be used, we just fall back to the API.
+        """
+        from authlib.jose.errors import JoseError
+        try:
+            claims = verify_access_token(access_token)
+        except (JoseError, ValueError, RequestException):
+            app.logger.exception('Failed to verify access token, will use the Management API '
+                                 'for permissions instead.')
+            return
+        if 'permissions' not in claims:
+            app.logger.warning('Access token has no `permissions` claim. Is "Add Permissions '
+                               'in the Access Token" enabled for the API?')
+            return
+        session[self.permissions_cookie] = {
+            'permissions': claims['permissions'],
+            'expires_at': claims['exp'],
+        }
+
     @property
     def permissions(self) -> List[str]:
-        # TODO: give RBAC another try; it should work for this
+        token_permissions = session.get(self.permissions_cookie)
+        if token_permissions and time.time() < token_permissions['expires_at']:
+            return token_permissions['permissions']
+
         page_count = 0
         permissions = []
         while True:
@@ -103,13 +154,15 @@ class _CurrentUser:
         return permissions
 
     def send_password_reset_email(self):
-        requests.post(
-            f'https://{conf.AUTH0_DOMAIN}/dbconnections/change_password',
-            data={
-                'email': self.profile['email'],
-                'connection': 'Username-Password-Authentication'
-            }
-        )
+        email_address = self.profile['email']
+        with _auth_api_slots:
+            requests.post(
+                f'https://{conf.AUTH0_DOMAIN}/dbconnections/change_password',
+                data={
+                    'email': email_address,
+                    'connection': 'Username-Password-Authentication'
+                }
+            )
 
 
 current_user = _CurrentUser()
@@ -130,7 +183,7 @@ def login_redirect():
       - https://auth0.com/docs/flows/guides/auth-code/call-api-auth-code
 
     """
-    return _oauth_client.authorize_redirect(
+    return _oauth_client().authorize_redirect(
         redirect_uri=url_for('login_callback', _external=True),
         audience=conf.AUTH0_AUDIENCE
     )
@@ -142,14 +195,22 @@ def handle_login_callback():
 
     The authorization code is fetched from the request context and exchanged
     for an access token. The access token is used to call the /userinfo resource
-    for the user ID and name, which are then stored in the session.
+    for the user ID and name, which are then stored in the session. If
+    `AUTH0_RBAC_TOKEN_PERMISSIONS` is set, the permissions listed in the access token
+    are stored in the session too.
 
     See links in `login_redirect` docstring.
     """
-    _oauth_client.authorize_access_token()  # raises if invalid
-    userinfo = _oauth_client.get('userinfo').json()
+    with profiling.span('auth0'), _auth_api_slots, \
+            metrics.auth0_oauth_seconds.labels('authorization_code').time():
+        token = _oauth_client().authorize_access_token()  # raises if invalid
+    with profiling.span('auth0'), _auth_api_slots, \
+            metrics.auth0_oauth_seconds.labels('userinfo').time():
+        userinfo = _oauth_client().get('userinfo').json()
     user_id = userinfo['sub']
     current_user.log_in(user_id)
+    if conf.AUTH0_RBAC_TOKEN_PERMISSIONS:
+        current_user.store_token_permissions(token['access_token'])
     return session.pop('login_destination', None)
 
 
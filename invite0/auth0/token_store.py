@@ -0,0 +1,72 @@
+"""
+A Management API access token shared by every process on the host
+
+Without this, each gunicorn worker fetches its own token on its first request and again
+whenever it expires or the worker restarts, and Auth0 limits how many tokens a client may be
+issued. With `AUTH0_MGMT_TOKEN_DIR` set (ideally to a tmpfs, like /dev/shm), the token is kept
+in a file there instead, and a lock file ensures that only one process fetches a new one.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+import invite0.config as conf
+from invite0.concurrency import is_cooperative
+
+
+def _path() -> str:
+    # keyed by client and tenant, in case several deployments share the directory
+    key = hashlib.sha256(f'{conf.AUTH0_CLIENT_ID}@{conf.AUTH0_DOMAIN}'.encode()).hexdigest()
+    return os.path.join(conf.AUTH0_MGMT_TOKEN_DIR, f'invite0-mgmt-token-{key[:16]}.json')
+
+
+def _lock(lock_file):
+    if is_cooperative():
+        # `flock` blocks the OS thread, and so under gevent every greenlet in the process. Wait
+        # in one of gevent's threads instead.
+        from gevent import get_hub
+        get_hub().threadpool.apply(fcntl.flock, (lock_file, fcntl.LOCK_EX))
+    else:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+
+@contextmanager
+def locked():
+    """Hold an exclusive lock on the token file (blocks until other processes release it)"""
+    with open(_path() + '.lock', 'a') as lock_file:
+        _lock(lock_file)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read() -> Optional[Tuple[str, float, float]]:
+    """Return the stored (access token, expiration time, time to refresh), if any"""
+    try:
+        with open(_path()) as file:
+            token = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+    return token['access_token'], token['expires_at'], token['refresh_at']
+
+
+def write(token: Tuple[str, float, float]):
+    access_token, expires_at, refresh_at = token
+    # write to a private temp file and rename it, so readers never see a partial token
+    fd, tmp_path = tempfile.mkstemp(dir=conf.AUTH0_MGMT_TOKEN_DIR)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump({
+                'access_token': access_token,
+                'expires_at': expires_at,
+                'refresh_at': refresh_at,
+            }, file)
+        os.replace(tmp_path, _path())
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
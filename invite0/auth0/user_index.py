@@ -0,0 +1,314 @@
+"""
+A local index of the email addresses of the tenant's users (`AUTH0_USER_INDEX`)
+
+With it, `admin.user_exists` and `admin.users_exist` are answered from SQLite rather than the
+Management API, so bulk invite jobs need no Auth0 reads to skip existing users.
+
+The index is seeded from a user export (`/jobs/users-exports`), whose gzipped file is streamed
+into the database a chunk at a time, and is then kept up to date by searching for users updated
+since the last sync, every `AUTH0_USER_INDEX_SYNC_SECONDS`. `admin.create_user` adds to it
+straight away. Each process runs a syncer thread, but they take turns via a lease in the
+database, much like bulk invite jobs, so only one syncs at a time.
+
+Incremental syncs only see users that were created or changed, so a user who is deleted or
+changes their email address lingers in the index until the next full export, every
+`AUTH0_USER_INDEX_RESEED_HOURS`. If the index hasn't been synced in
+`AUTH0_USER_INDEX_MAX_STALENESS` seconds (eg Auth0 is down), lookups go back to Auth0.
+
+With several tenants (see `invite0.tenants`), each has an index of its own, and the syncer
+takes care of them all, in turn. That keeps each tenant's Management API client in use, so
+they're never dropped for being idle.
+See: https://auth0.com/docs/users/bulk-user-exports
+"""
+import gzip
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from threading import Thread
+from types import SimpleNamespace
+from typing import Iterable, Optional, Set
+
+import requests
+from flask import current_app as app
+
+import invite0.config as conf
+import invite0.auth0.management_client as auth0_mgmt
+from invite0 import db, tenants
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS user_emails (
+    email    TEXT PRIMARY KEY,  -- lowercased, as Auth0 stores them
+    added_at REAL NOT NULL
+) WITHOUT ROWID;
+
+-- an export being loaded, swapped into `user_emails` once it's all there
+CREATE TABLE IF NOT EXISTS seed_emails (
+    email TEXT PRIMARY KEY
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    id            INTEGER PRIMARY KEY CHECK (id = 1),
+    seeded_at     REAL,  -- when the export behind the index was requested
+    synced_at     REAL,  -- when the last successful sync (of either kind) started
+    updated_since TEXT,  -- `updated_at` of the most recently updated user seen
+    lease_id      TEXT,
+    leased_until  REAL
+);
+INSERT OR IGNORE INTO sync_state (id) VALUES (1);
+'''
+
+_POLL_INTERVAL = 10  # seconds between checks for a due sync
+_LEASE_SECONDS = 120  # renewed as the sync makes progress
+_EXPORT_POLL_INTERVAL = 5  # seconds between checks on the export job
+_EXPORT_TIMEOUT = (10, 60)  # seconds to connect to, and wait for each chunk of, the export file
+_CHUNK_SIZE = 1000  # rows per transaction
+_LOOKUP_CHUNK_SIZE = 500  # addresses per query, within SQLite's limit on parameters
+# Search results are capped at 1000 per query, however they're paged.
+# See: https://auth0.com/docs/users/user-search/view-search-results-by-page#limitation
+_SEARCH_PAGE_SIZE = 100
+_SEARCH_LIMIT = 1000
+# Users show up in search a little after they're updated, so each sync goes back this far
+# before the last one's most recent update, to catch any that showed up late.
+_SEARCH_LAG = timedelta(minutes=5)
+_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'  # as in `updated_at`
+
+_syncer = SimpleNamespace(
+    thread=None,
+)
+
+
+class _LeaseLost(Exception):
+    """Another process has taken over the sync, eg because ours stalled past its lease"""
+
+
+def _db():
+    return db.connect(tenants.scoped('users'), _SCHEMA)
+
+
+def _state():
+    return _db().execute('SELECT * FROM sync_state').fetchone()
+
+
+def is_fresh() -> bool:
+    """Whether the index is recent enough to use (see `AUTH0_USER_INDEX_MAX_STALENESS`)"""
+    synced_at = _state()['synced_at']
+    return synced_at is not None and time.time() - synced_at <= conf.AUTH0_USER_INDEX_MAX_STALENESS
+
+
+def existing(email_addresses: Iterable[str]) -> Set[str]:
+    """:return: those of the (lowercase) `email_addresses` that belong to a user"""
+    conn = _db()
+    email_addresses = iter(email_addresses)
+    found = set()
+    while True:
+        chunk = list(islice(email_addresses, _LOOKUP_CHUNK_SIZE))
+        if not chunk:
+            return found
+        placeholders = ', '.join('?' * len(chunk))
+        found.update(row[0] for row in conn.execute(
+            f'SELECT email FROM user_emails WHERE email IN ({placeholders})', chunk
+        ))
+
+
+def add(email_address: str):
+    """Add a user that we know exists, eg because we just created it"""
+    conn = _db()
+    with db.transaction(conn):
+        conn.execute(
+            'INSERT OR REPLACE INTO user_emails (email, added_at) VALUES (?, ?)',
+            (email_address.lower(), time.time())
+        )
+
+
+def _format_timestamp(moment: datetime) -> str:
+    # like `updated_at`, to the millisecond, so that they compare as strings
+    return moment.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def _take_lease() -> Optional[SimpleNamespace]:
+    """If a sync is due and nobody else is doing it, lease it and return what's to be done"""
+    conn = _db()
+    now = time.time()
+    with db.transaction(conn):
+        state = conn.execute('SELECT * FROM sync_state').fetchone()
+        if state['leased_until'] is not None and state['leased_until'] > now:
+            return None
+        if (state['seeded_at'] is None
+                or now - state['seeded_at'] > conf.AUTH0_USER_INDEX_RESEED_HOURS * 60 * 60):
+            kind = 'seed'
+        elif now - state['synced_at'] >= conf.AUTH0_USER_INDEX_SYNC_SECONDS:
+            kind = 'update'
+        else:
+            return None
+        lease_id = uuid.uuid4().hex
+        conn.execute(
+            'UPDATE sync_state SET lease_id = ?, leased_until = ?',
+            (lease_id, now + _LEASE_SECONDS)
+        )
+    return SimpleNamespace(kind=kind, id=lease_id, updated_since=state['updated_since'])
+
+
+def _renew_lease(lease):
+    conn = _db()
+    with db.transaction(conn):
+        cursor = conn.execute(
+            'UPDATE sync_state SET leased_until = ? WHERE lease_id = ?',
+            (time.time() + _LEASE_SECONDS, lease.id)
+        )
+    if cursor.rowcount == 0:
+        raise _LeaseLost
+
+
+def _release_lease(conn, lease, **updates):
+    """Give up the lease, recording `updates` to the sync state. Caller must hold a transaction."""
+    assignments = ''.join(f', {column} = ?' for column in updates)
+    cursor = conn.execute(
+        f'UPDATE sync_state SET lease_id = NULL, leased_until = NULL{assignments} '
+        'WHERE lease_id = ?',
+        (*updates.values(), lease.id)
+    )
+    if cursor.rowcount == 0:
+        raise _LeaseLost
+
+
+def _export_rows(location: str):
+    """Yield the users in an export file, without holding the whole file in memory"""
+    with requests.get(location, stream=True, timeout=_EXPORT_TIMEOUT) as response:
+        response.raise_for_status()
+        # the file is gzipped whatever the response headers say, so skip requests' decoding
+        for line in gzip.GzipFile(fileobj=response.raw):
+            if line.strip():
+                yield json.loads(line)
+
+
+def _seed(lease):
+    """Replace the index with a fresh export of all the tenant's users"""
+    requested_at = time.time()
+    job = auth0_mgmt.post('/jobs/users-exports', json={
+        'format': 'json',  # one user per line
+        'fields': [{'name': 'email'}, {'name': 'updated_at'}],
+    }).json()
+    while job['status'] in ('pending', 'processing'):
+        time.sleep(_EXPORT_POLL_INTERVAL)
+        _renew_lease(lease)
+        job = auth0_mgmt.get(f"/jobs/{job['id']}").json()
+    if job['status'] != 'completed':
+        raise RuntimeError(f"User export {job['id']} {job['status']}")
+
+    conn = _db()
+    with db.transaction(conn):
+        conn.execute('DELETE FROM seed_emails')
+    users = _export_rows(job['location'])
+    latest_update = _format_timestamp(datetime.fromtimestamp(requested_at, timezone.utc))
+    count = 0
+    while True:
+        chunk = list(islice(users, _CHUNK_SIZE))
+        if not chunk:
+            break
+        with db.transaction(conn):
+            conn.executemany('INSERT OR IGNORE INTO seed_emails (email) VALUES (?)', (
+                (user['email'].lower(),) for user in chunk if user.get('email')
+            ))
+        latest_update = max([latest_update, *(user.get('updated_at', '') for user in chunk)])
+        count += len(chunk)
+        _renew_lease(lease)
+
+    with db.transaction(conn):
+        # keep users added (by `add`) since the export was requested, which it may have missed
+        conn.execute(
+            'INSERT OR IGNORE INTO seed_emails (email) '
+            'SELECT email FROM user_emails WHERE added_at >= ?', (requested_at,)
+        )
+        conn.execute('DELETE FROM user_emails')
+        conn.execute(
+            'INSERT INTO user_emails (email, added_at) SELECT email, ? FROM seed_emails',
+            (requested_at,)
+        )
+        conn.execute('DELETE FROM seed_emails')
+        _release_lease(conn, lease, seeded_at=requested_at, synced_at=requested_at,
+                       updated_since=latest_update)
+    app.logger.info(f'Seeded the user index with {count} users.')
+
+
+def _updated_users(since: str):
+    """Yield the users updated since `since` (give or take), least recently updated first"""
+    for page_count in range(_SEARCH_LIMIT // _SEARCH_PAGE_SIZE):
+        page = auth0_mgmt.get('/users', params={
+            'q': f'updated_at:[{since} TO *]',
+            'search_engine': 'v3',
+            'sort': 'updated_at:1',
+            'fields': 'email,updated_at',
+            'include_fields': 'true',
+            'per_page': _SEARCH_PAGE_SIZE,
+            'page': page_count,
+        }).json()
+        yield from page
+        if len(page) < _SEARCH_PAGE_SIZE:
+            return
+
+
+def _update(lease):
+    """Add the users created or updated since the last sync"""
+    started_at = time.time()
+    conn = _db()
+    latest_update = lease.updated_since
+    while True:
+        since = datetime.strptime(latest_update, _TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+        users = list(_updated_users(_format_timestamp(since - _SEARCH_LAG)))
+        with db.transaction(conn):
+            conn.executemany(
+                'INSERT OR REPLACE INTO user_emails (email, added_at) VALUES (?, ?)',
+                ((user['email'].lower(), started_at) for user in users if user.get('email'))
+            )
+        previous_update = latest_update
+        latest_update = max([latest_update, *(user['updated_at'] for user in users)])
+        _renew_lease(lease)
+        if len(users) < _SEARCH_LIMIT:
+            break  # that's all of them
+        if latest_update == previous_update:
+            # more than a search's worth of users updated at once -- we can't page past them
+            with db.transaction(conn):
+                _release_lease(conn, lease, seeded_at=None)
+            app.logger.warning('Too many users updated at once to sync, will reseed the '
+                               'user index instead.')
+            return
+    with db.transaction(conn):
+        _release_lease(conn, lease, synced_at=started_at, updated_since=latest_update)
+
+
+def _sync():
+    """Sync the current tenant's index, if it's due and nobody else is"""
+    try:
+        lease = _take_lease()
+        if lease is not None:
+            {'seed': _seed, 'update': _update}[lease.kind](lease)
+    except _LeaseLost:
+        app.logger.warning('Lost the user index sync lease to another process.')
+    except Exception:
+        # the lease will run out, and we (or another process) will try again
+        app.logger.exception('Failed to sync the user index')
+
+
+def _sync_forever(app_obj):
+    with app_obj.app_context():
+        while True:
+            for name in tenants.names():
+                with tenants.use(tenants.get(name)):
+                    _sync()
+            time.sleep(_POLL_INTERVAL)
+
+
+def start_syncer(app_obj):
+    """Start this process's user index syncer thread"""
+    if _syncer.thread is not None:
+        return
+    _syncer.thread = Thread(
+        target=_sync_forever,
+        args=[app_obj],
+        name='user-index-syncer',
+        daemon=True,
+    )
+    _syncer.thread.start()
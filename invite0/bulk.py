@@ -0,0 +1,169 @@
+"""
+The bulk invite engine
+
+Addresses flow through three stages -- existence checks against Auth0, token/link generation,
+and sending -- each with its own threads (see `BULK_INVITE_*_CONCURRENCY`), so that waiting on
+Auth0 and waiting on the mail server overlap rather than add up. The stages are connected by
+bounded queues, so a slow stage holds back the ones before it rather than letting work pile up
+in memory.
+
+The stage threads are started once per process, when first needed, and shared by all bulk invite
+jobs -- there are enough of them for `BULK_INVITE_WORKERS` jobs at once. Each job's slices are
+fed through the queues in batches, which carry what's needed to handle them (the tenant, where
+to record progress, etc) along with the addresses.
+"""
+from queue import Queue
+from smtplib import SMTPRecipientsRefused
+from threading import Event, Lock, Thread
+from types import SimpleNamespace
+
+from flask import url_for, current_app as app
+
+import invite0.config as conf
+from invite0 import tenants
+from invite0.auth0.admin import users_exist
+from invite0.mail import pooled_connection, send_invite
+from invite0.tokens import generate_activation_token, generate_token
+
+
+_LOOKUP_BATCH_SIZE = 50  # addresses per existence check
+_SEND_BATCH_SIZE = 10  # invites sent per SMTP connection borrowed from the pool
+_QUEUE_SIZE = 20  # max batches waiting between stages
+
+_engine = SimpleNamespace(
+    lock=Lock(),
+    inbox=None,  # the first stage's queue, once the stage threads are started
+)
+
+
+def _hold(task):
+    with task.lock:
+        task.pending += 1
+
+
+def _release(task):
+    with task.lock:
+        task.pending -= 1
+        if task.pending == 0:
+            task.done.set()
+
+
+def _start_stage(name, concurrency, work, inbox, outbox):
+    """
+    Start `concurrency` threads that each run `work(task, items, emit)` for each batch of items
+    in `inbox`
+
+    `emit(items)` passes a batch on to the next stage, for the same task. If `work` raises, the
+    task's remaining batches are dropped, and the error is re-raised by `send_bulk_invites`.
+    """
+    def run():
+        while True:
+            task, items = inbox.get()
+
+            def emit(items):
+                _hold(task)
+                outbox.put((task, items))
+
+            try:
+                if not task.errors:
+                    # the tenant first, so the app context's `url_for` makes the tenant's links
+                    with tenants.use(task.tenant), task.app.app_context():
+                        work(task, items, emit)
+            except Exception as e:
+                task.errors.append(e)
+            finally:
+                _release(task)
+
+    for i in range(concurrency):
+        Thread(target=run, name=f'bulk-invite-{name}-{i}', daemon=True).start()
+
+
+def _look_up(task, email_addresses, emit):
+    existing = set() if task.provisioned else users_exist(email_addresses)
+    to_invite = []
+    for email_address in email_addresses:
+        if email_address in existing:
+            task.checkpoint(email_address, 'skipped')
+        else:
+            to_invite.append(email_address)
+    for i in range(0, len(to_invite), _SEND_BATCH_SIZE):
+        emit(to_invite[i:i + _SEND_BATCH_SIZE])
+
+
+def _make_links(task, email_addresses, emit):
+    endpoint = 'activate' if task.provisioned else 'signup'
+    make_token = generate_activation_token if task.provisioned else generate_token
+    emit([
+        (email_address, url_for(endpoint, token=make_token(email_address), _external=True))
+        for email_address in email_addresses
+    ])
+
+
+def _send(task, invites, emit):
+    # A connection is borrowed for a few invites at a time, once they're ready, rather than for
+    # the whole job, so that single invites and other jobs get their turn in the pool.
+    with pooled_connection() as conn:
+        for email_address, link in invites:
+            try:
+                send_invite(email_address, link, conn)
+            except SMTPRecipientsRefused:
+                app.logger.warning(f'Mail server refused {email_address}')
+                task.checkpoint(email_address, 'failed')
+            else:
+                task.checkpoint(email_address, 'sent')
+
+
+def _start_engine():
+    with _engine.lock:
+        if _engine.inbox is not None:
+            return
+        batches = Queue(maxsize=_QUEUE_SIZE)
+        to_link = Queue(maxsize=_QUEUE_SIZE)
+        to_send = Queue(maxsize=_QUEUE_SIZE)
+        jobs = conf.BULK_INVITE_WORKERS
+        _start_stage('lookup', conf.BULK_INVITE_LOOKUP_CONCURRENCY * jobs, _look_up,
+                     batches, to_link)
+        _start_stage('link', conf.BULK_INVITE_LINK_CONCURRENCY * jobs, _make_links,
+                     to_link, to_send)
+        _start_stage('send', conf.BULK_INVITE_SEND_CONCURRENCY * jobs, _send,
+                     to_send, None)
+        _engine.inbox = batches
+
+
+def send_bulk_invites(email_addresses, checkpoint, provisioned=False):
+    """
+    Send invites to multiple email addresses
+
+    `checkpoint(email_address, state)` is called as each address is done with, where `state` is
+    'skipped' (user already exists), 'sent', or 'failed' (rejected by the mail server). It's
+    called from several threads at once.
+
+    If `provisioned`, the users have already been created (see `invite0.jobs`), so rather than
+    checking that they don't exist and linking to the signup page, the invites link to the
+    page for setting a password.
+
+    Returns once all of the addresses are done with. If any stage fails, the rest of the
+    addresses are dropped, and the exception is re-raised here.
+    """
+    _start_engine()
+    task = SimpleNamespace(
+        app=app._get_current_object(),
+        tenant=tenants.current(),
+        checkpoint=checkpoint,
+        provisioned=provisioned,
+        lock=Lock(),
+        pending=1,  # batches not yet done with, plus one until they've all been fed in
+        done=Event(),
+        errors=[],
+    )
+    try:
+        for i in range(0, len(email_addresses), _LOOKUP_BATCH_SIZE):
+            if task.errors:
+                break
+            _hold(task)
+            _engine.inbox.put((task, email_addresses[i:i + _LOOKUP_BATCH_SIZE]))
+    finally:
+        _release(task)
+    task.done.wait()
+    if task.errors:
+        raise task.errors[0]
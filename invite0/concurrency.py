@@ -0,0 +1,27 @@
+"""
+Running under gevent
+
+With gunicorn's gevent workers (`GUNICORN_CMD_ARGS=--worker-class=gevent`, see README.md), the
+standard library is monkey-patched before Invite0 is imported, so sockets, locks, queues,
+`time.sleep`, `threading.local` and `threading.Thread` all cooperate as greenlets. That means:
+- a request waiting on Auth0 or the mail server no longer ties up the whole worker, so one
+  process can serve hundreds of them
+- the bulk invite workers, pipeline stages, and token refresher -- all `threading.Thread`s --
+  run as greenlets, and the module-level state they share (clients, pools, rate limiter,
+  caches) is guarded by `threading` locks, which become greenlet locks
+- per-thread state is per greenlet, except for `db`'s connections, which stay per OS thread
+
+What gevent takes away is the natural cap on concurrency that one-request-per-process gave us,
+so each upstream has a limit of its own: `AUTH0_MGMT_POOL_SIZE` for the Management API,
+`AUTH0_AUTH_POOL_SIZE` for logins and other Authentication API calls, and `MAIL_POOL_SIZE` for
+SMTP. Requests beyond these wait their turn rather than opening ever more connections.
+
+`BULK_INVITE_MODE=asyncio` runs its own event loop thread, which doesn't mix with gevent's.
+"""
+import sys
+
+
+def is_cooperative() -> bool:
+    """Whether gevent has monkey-patched the standard library, eg in a gevent gunicorn worker"""
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    return bool(gevent_monkey and gevent_monkey.is_module_patched('threading'))
@@ -1,36 +1,97 @@
+import json
+import os
+
 from environs import Env
 
 from invite0 import data
+from invite0.concurrency import is_cooperative
 
 
 env = Env()
 env.read_env()
 
-SERVER_NAME = env.str('INVITE0_DOMAIN')
-ORG_NAME = env.str('ORG_NAME')
+# serve several Auth0 tenants from one deployment, see tenants.py. With it, the settings in
+# TENANT_KEYS (below) needn't be set here, and if they are, they're defaults for the tenants.
+TENANTS_FILE = env.str('TENANTS_FILE', default=None)
+TENANT_IDLE_SECONDS = env.int('TENANT_IDLE_SECONDS', default=15 * 60)  # before its clients go
+_per_tenant = {'default': None} if TENANTS_FILE else {}
+
+SERVER_NAME = env.str('INVITE0_DOMAIN', **_per_tenant)
+ORG_NAME = env.str('ORG_NAME', **_per_tenant)
 ORG_LOGO = env.url('ORG_LOGO', default=None).geturl()
 USER_FIELDS = env.list('USER_FIELDS', default=['picture', 'nickname', 'given_name', 'family_name'])
 REQUIRED_USER_FIELDS = env.list('REQUIRED_USER_FIELDS', default=[])
 INVITE_EXPIRATION_DAYS = env.decimal('INVITE_EXPIRATION_DAYS', default=5)
+# don't invite an address again within this many hours, unless the admin insists. 0 to disable.
+INVITE_RESEND_HOURS = env.float('INVITE_RESEND_HOURS', default=24)
 INVITE_SUBJECT = env.str('INVITE_SUBJECT', default=f'{ORG_NAME} | Sign Up')
 INVITE_PERMISSION = env.str('INVITE_PERMISSION', default='send:invitation')
 WELCOME_URL = env.url('WELCOME_URL', default=None).geturl()
-SECRET_KEY = env.str('SECRET_KEY')
+SECRET_KEY = env.str('SECRET_KEY', **_per_tenant)
+# for bulk invite jobs, etc. The Docker image sets /var/lib/invite0.
+DATA_DIR = env.str('DATA_DIR', default=os.path.abspath('instance'))
+BULK_INVITE_WORKERS = env.int('BULK_INVITE_WORKERS', default=2)  # max concurrent bulk invite jobs
+# finished jobs, and the addresses they were for, are deleted after this many days
+BULK_JOB_RETENTION_DAYS = env.float('BULK_JOB_RETENTION_DAYS', default=30)
+BULK_INVITE_MODE = env.str('BULK_INVITE_MODE', default='threads')  # or 'asyncio', see aio.py
+# threads (or coroutines) per bulk invite job for each stage -- see bulk.py. In threads mode the
+# process starts this many times BULK_INVITE_WORKERS, shared by its jobs.
+BULK_INVITE_LOOKUP_CONCURRENCY = env.int('BULK_INVITE_LOOKUP_CONCURRENCY', default=2)
+BULK_INVITE_LINK_CONCURRENCY = env.int('BULK_INVITE_LINK_CONCURRENCY', default=1)
+# SMTP connections
+BULK_INVITE_SEND_CONCURRENCY = env.int('BULK_INVITE_SEND_CONCURRENCY', default=4)
+
+# fetch the Management API token etc before serving any requests, see startup.py
+WARM_UP = env.bool('WARM_UP', default=False)
+
+# if set, /metrics is only served to requests with an `Authorization: Bearer <token>` header
+METRICS_TOKEN = env.str('METRICS_TOKEN', default=None)
 
-MAIL_SERVER = env.str('MAIL_SERVER')
-MAIL_PORT = env.str('MAIL_PORT')
+# log a timing breakdown of requests slower than this, 0 to disable. See profiling.py.
+SLOW_REQUEST_MS = env.int('SLOW_REQUEST_MS', default=2000)
+PROFILE_ENDPOINTS = env.list('PROFILE_ENDPOINTS', default=[])  # profile every request to these
+# who can get a token to profile any request they make
+PROFILE_PERMISSION = env.str('PROFILE_PERMISSION', default='profile:requests')
+PROFILE_SAMPLE_MS = env.float('PROFILE_SAMPLE_MS', default=5)
+PROFILE_MAX_FILES = env.int('PROFILE_MAX_FILES', default=200)  # the oldest profiles are deleted
+
+MAIL_SERVER = env.str('MAIL_SERVER', **_per_tenant)
+MAIL_PORT = env.str('MAIL_PORT', **_per_tenant)
 MAIL_USE_TLS = env.bool('MAIL_USE_TLS', default=False)
 MAIL_USE_SSL = env.bool('MAIL_USE_SSL', default=False)
-MAIL_USERNAME = env.str('MAIL_USERNAME')
-MAIL_PASSWORD = env.str('MAIL_PASSWORD')
+MAIL_USERNAME = env.str('MAIL_USERNAME', **_per_tenant)
+MAIL_PASSWORD = env.str('MAIL_PASSWORD', **_per_tenant)
 MAIL_SENDER_NAME = env.str('MAIL_SENDER_NAME', default=None)
-MAIL_SENDER_ADDRESS = env.str('MAIL_SENDER_ADDRESS')
+MAIL_SENDER_ADDRESS = env.str('MAIL_SENDER_ADDRESS', **_per_tenant)
 MAIL_MAX_EMAILS = env.int('MAIL_MAX_EMAILS', default=None)
+MAIL_POOL_SIZE = env.int('MAIL_POOL_SIZE', default=4)  # max concurrent SMTP connections
 
-AUTH0_CLIENT_ID = env.str('AUTH0_CLIENT_ID')
-AUTH0_CLIENT_SECRET = env.str('AUTH0_CLIENT_SECRET')
-AUTH0_AUDIENCE = env.str('AUTH0_AUDIENCE')
-AUTH0_DOMAIN = env.str('AUTH0_DOMAIN')
+AUTH0_CLIENT_ID = env.str('AUTH0_CLIENT_ID', **_per_tenant)
+AUTH0_CLIENT_SECRET = env.str('AUTH0_CLIENT_SECRET', **_per_tenant)
+AUTH0_AUDIENCE = env.str('AUTH0_AUDIENCE', **_per_tenant)
+AUTH0_DOMAIN = env.str('AUTH0_DOMAIN', **_per_tenant)
+# Read the user's permissions from their access token rather than the Management API. Requires
+# "Enable RBAC" and "Add Permissions in the Access Token" in the settings of the AUTH0_AUDIENCE API.
+AUTH0_RBAC_TOKEN_PERMISSIONS = env.bool('AUTH0_RBAC_TOKEN_PERMISSIONS', default=False)
+AUTH0_JWKS_REFRESH_SECONDS = env.int('AUTH0_JWKS_REFRESH_SECONDS', default=60 * 60)
+AUTH0_TIER = env.str('AUTH0_TIER', default='free')
+# override the tier's defaults, eg if you've negotiated a custom limit
+AUTH0_MGMT_API_RATE_LIMIT = env.float('AUTH0_MGMT_API_RATE_LIMIT', default=None)  # requests/second
+AUTH0_MGMT_API_BURST = env.int('AUTH0_MGMT_API_BURST', default=None)
+# share the Management API token between processes via this directory, eg /dev/shm
+AUTH0_MGMT_TOKEN_DIR = env.str('AUTH0_MGMT_TOKEN_DIR', default=None)
+AUTH0_MGMT_POOL_SIZE = env.int('AUTH0_MGMT_POOL_SIZE', default=10)  # max concurrent connections
+# max concurrent Authentication API requests (logins, password resets)
+AUTH0_AUTH_POOL_SIZE = env.int('AUTH0_AUTH_POOL_SIZE', default=10)
+AUTH0_MGMT_CACHE = env.bool('AUTH0_MGMT_CACHE', default=False)
+AUTH0_MGMT_CACHE_MAX_BYTES = env.int('AUTH0_MGMT_CACHE_MAX_BYTES', default=16 * 1024 * 1024)
+# keep a local index of users' email addresses for existence checks, see auth0/user_index.py
+AUTH0_USER_INDEX = env.bool('AUTH0_USER_INDEX', default=False)
+AUTH0_USER_INDEX_SYNC_SECONDS = env.int('AUTH0_USER_INDEX_SYNC_SECONDS', default=60)
+# if the index hasn't been synced for this long, existence checks go to Auth0 again
+AUTH0_USER_INDEX_MAX_STALENESS = env.int('AUTH0_USER_INDEX_MAX_STALENESS', default=15 * 60)
+# full export, which also drops deleted users
+AUTH0_USER_INDEX_RESEED_HOURS = env.int('AUTH0_USER_INDEX_RESEED_HOURS', default=24)
 
 
 # validations
@@ -51,3 +112,119 @@ for field in USER_FIELDS:
 for field in REQUIRED_USER_FIELDS:
     if field not in USER_FIELDS:
         raise ConfigError('REQUIRED_USER_FIELDS', f'"{field}" not present in USER_FIELDS.')
+
+if AUTH0_TIER not in data.MGMT_API_RATE_LIMITS:
+    raise ConfigError('AUTH0_TIER', f'Unknown tier: "{AUTH0_TIER}".')
+
+if AUTH0_MGMT_API_RATE_LIMIT is not None and AUTH0_MGMT_API_RATE_LIMIT <= 0:
+    raise ConfigError('AUTH0_MGMT_API_RATE_LIMIT', 'Must be positive.')
+
+if AUTH0_MGMT_TOKEN_DIR and not os.path.isdir(AUTH0_MGMT_TOKEN_DIR):
+    raise ConfigError('AUTH0_MGMT_TOKEN_DIR', f'"{AUTH0_MGMT_TOKEN_DIR}" is not a directory.')
+
+try:
+    os.makedirs(DATA_DIR, exist_ok=True)
+except OSError as e:
+    raise ConfigError('DATA_DIR', f'Can\'t create "{DATA_DIR}": {e.strerror}.')
+if not os.access(DATA_DIR, os.W_OK):
+    raise ConfigError('DATA_DIR', f'"{DATA_DIR}" is not writable.')
+
+if BULK_INVITE_MODE not in ['threads', 'asyncio']:
+    raise ConfigError('BULK_INVITE_MODE', f'Unknown mode: "{BULK_INVITE_MODE}".')
+
+if BULK_INVITE_MODE == 'asyncio' and is_cooperative():
+    raise ConfigError('BULK_INVITE_MODE', 'asyncio mode can not be used with gevent workers.')
+
+for key in ['BULK_INVITE_WORKERS', 'BULK_INVITE_LOOKUP_CONCURRENCY',
+            'BULK_INVITE_LINK_CONCURRENCY', 'BULK_INVITE_SEND_CONCURRENCY']:
+    if globals()[key] < 1:
+        raise ConfigError(key, 'Must be at least 1.')
+
+if BULK_JOB_RETENTION_DAYS <= 0:
+    raise ConfigError('BULK_JOB_RETENTION_DAYS', 'Must be positive.')
+
+for key in ['MAIL_POOL_SIZE', 'AUTH0_MGMT_POOL_SIZE', 'AUTH0_AUTH_POOL_SIZE']:
+    if globals()[key] < 1:
+        raise ConfigError(key, 'Must be at least 1.')
+
+for key in ['AUTH0_USER_INDEX_SYNC_SECONDS', 'AUTH0_USER_INDEX_RESEED_HOURS']:
+    if globals()[key] < 1:
+        raise ConfigError(key, 'Must be at least 1.')
+
+if AUTH0_USER_INDEX_MAX_STALENESS <= AUTH0_USER_INDEX_SYNC_SECONDS:
+    raise ConfigError('AUTH0_USER_INDEX_MAX_STALENESS',
+                      'Must be greater than AUTH0_USER_INDEX_SYNC_SECONDS.')
+
+if not 0 <= INVITE_RESEND_HOURS <= INVITE_EXPIRATION_DAYS * 24:
+    raise ConfigError('INVITE_RESEND_HOURS', 'Must be between 0 and INVITE_EXPIRATION_DAYS * 24.')
+
+if SLOW_REQUEST_MS < 0:
+    raise ConfigError('SLOW_REQUEST_MS', 'Must not be negative.')
+
+if PROFILE_SAMPLE_MS <= 0:
+    raise ConfigError('PROFILE_SAMPLE_MS', 'Must be positive.')
+
+if PROFILE_MAX_FILES < 1:
+    raise ConfigError('PROFILE_MAX_FILES', 'Must be at least 1.')
+
+if TENANT_IDLE_SECONDS < 1:
+    raise ConfigError('TENANT_IDLE_SECONDS', 'Must be at least 1.')
+
+
+# multi-tenant mode
+# --------------------------------------------------------------------------------------------------
+
+# the settings each tenant has its own of
+TENANT_KEYS = [
+    'SERVER_NAME', 'ORG_NAME', 'ORG_LOGO', 'INVITE_SUBJECT', 'WELCOME_URL', 'SECRET_KEY',
+    'MAIL_SERVER', 'MAIL_PORT', 'MAIL_USE_TLS', 'MAIL_USE_SSL', 'MAIL_USERNAME', 'MAIL_PASSWORD',
+    'MAIL_SENDER_NAME', 'MAIL_SENDER_ADDRESS',
+    'AUTH0_CLIENT_ID', 'AUTH0_CLIENT_SECRET', 'AUTH0_AUDIENCE', 'AUTH0_DOMAIN', 'AUTH0_TIER',
+    'AUTH0_MGMT_API_RATE_LIMIT', 'AUTH0_MGMT_API_BURST',
+]
+# those without a default, which every tenant needs one way or another
+_REQUIRED_TENANT_KEYS = [
+    'ORG_NAME', 'SECRET_KEY', 'MAIL_SERVER', 'MAIL_PORT', 'MAIL_USERNAME', 'MAIL_PASSWORD',
+    'MAIL_SENDER_ADDRESS', 'AUTH0_CLIENT_ID', 'AUTH0_CLIENT_SECRET', 'AUTH0_AUDIENCE',
+    'AUTH0_DOMAIN',
+]
+
+
+def _tenant_settings(server_name, overrides):
+    config_key = f'TENANTS_FILE: {server_name}'
+    unknown = set(overrides) - (set(TENANT_KEYS) - {'SERVER_NAME'})
+    if unknown:
+        raise ConfigError(config_key, f'Unknown or shared settings: {", ".join(sorted(unknown))}.')
+    settings = {**{key: globals()[key] for key in TENANT_KEYS}, **overrides,
+                'SERVER_NAME': server_name}
+    if 'INVITE_SUBJECT' not in overrides and not env.str('INVITE_SUBJECT', default=None):
+        settings['INVITE_SUBJECT'] = f"{settings['ORG_NAME']} | Sign Up"
+    missing = [key for key in _REQUIRED_TENANT_KEYS if settings[key] is None]
+    if missing:
+        raise ConfigError(config_key, f'Missing settings: {", ".join(missing)}.')
+    if settings['AUTH0_TIER'] not in data.MGMT_API_RATE_LIMITS:
+        raise ConfigError(config_key, f'Unknown AUTH0_TIER: "{settings["AUTH0_TIER"]}".')
+    rate_limit = settings['AUTH0_MGMT_API_RATE_LIMIT']
+    if rate_limit is not None and rate_limit <= 0:
+        raise ConfigError(config_key, 'AUTH0_MGMT_API_RATE_LIMIT must be positive.')
+    return settings
+
+
+if TENANTS_FILE:
+    with open(TENANTS_FILE) as f:
+        TENANTS = {  # server name -> settings
+            server_name.lower(): _tenant_settings(server_name.lower(), overrides)
+            for server_name, overrides in json.load(f).items()
+        }
+    if not TENANTS:
+        raise ConfigError('TENANTS_FILE', 'No tenants.')
+    # from now on, these are looked up in the current tenant's settings by `__getattr__`
+    for key in TENANT_KEYS:
+        del globals()[key]
+
+
+def __getattr__(name):
+    if TENANTS_FILE and name in TENANT_KEYS:
+        from invite0 import tenants
+        return tenants.current().config[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,12 +1,18 @@
-from wtforms.validators import URL
-
 ALL_USER_FIELDS = {
-    'phone_number': {'label': 'Phone Number', 'validators': []},
-    'given_name':   {'label': 'First Name',   'validators': []},
-    'family_name':  {'label': 'Last Name',    'validators': []},
-    'name':         {'label': 'Display Name', 'validators': []},
-    'nickname':     {'label': 'Nickname',     'validators': []},
-    'picture':      {'label': 'Picture URL',  'validators': [URL()]},
+    'phone_number': {'label': 'Phone Number'},
+    'given_name':   {'label': 'First Name'},
+    'family_name':  {'label': 'Last Name'},
+    'name':         {'label': 'Display Name'},
+    'nickname':     {'label': 'Nickname'},
+    'picture':      {'label': 'Picture URL'},
     # username currently not supported because we need to handle the uniqueness requirement
-    # 'username':     {'label': 'Username',     'validators': []},
+    # 'username':     {'label': 'Username'},
+}
+
+# Management API rate limits by Auth0 subscription tier: sustained requests/second and bucket size
+# see: https://auth0.com/docs/policies/rate-limit-policy/management-api-endpoint-rate-limits
+MGMT_API_RATE_LIMITS = {
+    'free':       {'rate': 2,  'burst': 10},
+    'developer':  {'rate': 15, 'burst': 50},
+    'enterprise': {'rate': 50, 'burst': 50},
 }
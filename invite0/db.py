@@ -0,0 +1,114 @@
+"""
+SQLite databases kept under `DATA_DIR`
+
+Each thread gets its own connection to each database, since SQLite connections can't be shared
+between threads. Connections are in autocommit mode; use `transaction` to group statements.
+The databases are in WAL mode, so readers (eg the web workers) don't block the writer (eg a bulk
+invite job), and several processes may use them at once.
+
+Under gevent (see `invite0.concurrency`), connections are per OS thread rather than per greenlet,
+so requests don't each open (and set up) a connection of their own. Greenlets in a thread share
+its connections, which is safe as long as nothing yields inside a `transaction` -- keep network
+calls out of them. Waiting for another process's write lock, which SQLite does by blocking,
+would block every greenlet in the process, so `transaction` polls for it instead, yielding in
+between.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Sequence
+
+import invite0.config as conf
+from invite0.concurrency import is_cooperative
+
+
+_BUSY_TIMEOUT = 30  # seconds to wait for another process's write lock
+_BUSY_POLL_INTERVAL = 0.05  # seconds between tries for the write lock, under gevent
+
+if is_cooperative():
+    from gevent.monkey import get_original
+    _local = get_original('threading', 'local')()  # per OS thread, as `threading.local` was
+else:
+    _local = threading.local()
+
+# databases whose schema and migrations this process has run
+_set_up = SimpleNamespace(lock=threading.Lock(), names=set())
+
+
+def connect(name: str, schema: str, migrations: Sequence[str] = ()) -> sqlite3.Connection:
+    """
+    Return this thread's connection to database `name`, creating it if necessary
+
+    :param schema: SQL script to set up the database. It's run on the process's first
+      connection, and should be idempotent (`CREATE TABLE IF NOT EXISTS`, etc).
+    :param migrations: SQL scripts to bring databases created with an older `schema` up to
+      date, oldest first. Only ever append to this. Each is run once per database, after
+      `schema`, and the number run so far is tracked with `PRAGMA user_version`.
+    """
+    connections = _local.__dict__.setdefault('connections', {})
+    if name not in connections:
+        os.makedirs(conf.DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(
+            os.path.join(conf.DATA_DIR, f'{name}.sqlite3'),
+            timeout=_BUSY_TIMEOUT,
+            isolation_level=None,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA synchronous = NORMAL')  # durable enough in WAL mode, and much faster
+        with _set_up.lock:
+            if name not in _set_up.names:
+                conn.execute('PRAGMA journal_mode = WAL')  # persistent, so once will do
+                conn.executescript(schema)
+                _migrate(conn, migrations)
+                _set_up.names.add(name)
+        if is_cooperative():
+            conn.execute('PRAGMA busy_timeout = 0')  # `transaction` waits instead
+        connections[name] = conn
+    return connections[name]
+
+
+def _migrate(conn, migrations):
+    with transaction(conn):
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for migration in migrations[version:]:
+            for statement in migration.split(';'):
+                conn.execute(statement)
+        # PRAGMA doesn't take parameters
+        conn.execute(f'PRAGMA user_version = {max(version, len(migrations))}')
+
+
+@contextmanager
+def transaction(conn: sqlite3.Connection):
+    """
+    Run the enclosed statements in a write transaction
+
+    The write lock is taken up front (`BEGIN IMMEDIATE`), so read-then-write sequences, like
+    leasing a job, are atomic across processes. Writes should all go through here, as under
+    gevent it's only here that we wait for the lock.
+    """
+    if is_cooperative():
+        _begin_cooperatively(conn)
+    else:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+
+
+def _begin_cooperatively(conn: sqlite3.Connection):
+    deadline = time.monotonic() + _BUSY_TIMEOUT
+    while True:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            return
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or time.monotonic() > deadline:
+                raise
+        time.sleep(_BUSY_POLL_INTERVAL)  # monkey-patched, so other greenlets run meanwhile
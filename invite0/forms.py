@@ -1,6 +1,7 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, TextAreaField
-from wtforms.validators import Email, DataRequired, EqualTo
+from flask_wtf.file import FileField, FileAllowed
+from wtforms import StringField, PasswordField, SubmitField, TextAreaField, BooleanField
+from wtforms.validators import Email, DataRequired, EqualTo, ValidationError, URL
 
 import invite0.config as conf
 from invite0 import data
@@ -8,13 +9,41 @@ from invite0 import data
 
 class InviteForm(FlaskForm):
     email = StringField('Email Address', validators=[Email(), DataRequired()])
+    force_resend = BooleanField('Send even if invited recently')
     submit_single = SubmitField('Send invititation')
 
 
 class BulkInviteForm(FlaskForm):
-    emails = TextAreaField('Email Addresses', validators=[DataRequired()])
+    emails = TextAreaField('Email Addresses')
+    emails_file = FileField('Or upload a file', validators=[
+        FileAllowed(['csv', 'txt'], 'Please upload a .csv or .txt file.')
+    ])
+    provision = BooleanField('Create the accounts now, and invite people to set a password')
+    force_resend = BooleanField('Send even to those invited recently')
     submit_bulk = SubmitField('Send invititations')
 
+    def validate_emails(self, field):
+        if not (field.data or '').strip() and not self.emails_file.data:
+            raise ValidationError('Please enter some email addresses or upload a file.')
+
+    def validate_provision(self, field):
+        # accounts created up front would lack the fields that signing up requires
+        if field.data and conf.REQUIRED_USER_FIELDS:
+            labels = [data.ALL_USER_FIELDS[name]['label'] for name in conf.REQUIRED_USER_FIELDS]
+            raise ValidationError("Accounts can't be created up front, as signing up requires "
+                                  f"{', '.join(labels)}.")
+
+
+class ActivateForm(FlaskForm):
+    submit = SubmitField('Set my password')
+
+
+# validators for some of `data.ALL_USER_FIELDS`, kept here so that `data` (and so `config`)
+# doesn't import WTForms
+_USER_FIELD_VALIDATORS = {
+    'picture': [URL],
+}
+
 
 # generate ProfileForm and SignUpForm dynamically based on `config.[REQUIRED_]USER_FIELDS`
 # TODO: could this be a good metaclass usecase?
@@ -23,7 +52,7 @@ def _generic_user_fields(required_only=False):
     form_fields = {}
     for field in (conf.REQUIRED_USER_FIELDS if required_only else conf.USER_FIELDS):
         field_data = data.ALL_USER_FIELDS[field]
-        validators = field_data['validators']
+        validators = [validator() for validator in _USER_FIELD_VALIDATORS.get(field, [])]
         if field in conf.REQUIRED_USER_FIELDS:
             validators.append(DataRequired())
         form_fields[field] = StringField(
@@ -0,0 +1,623 @@
+"""
+A durable queue for bulk invite jobs
+
+Jobs and the state of each of their addresses (pending, skipped, sent, or failed) are stored in
+SQLite, so they survive restarts and redeploys. Each process runs `BULK_INVITE_WORKERS` worker
+threads, which lease jobs from the database and work through them a slice at a time, recording
+each address as soon as it's done. If a worker dies mid-slice, its lease expires and another
+worker picks up where it left off. Jobs are deleted `BULK_JOB_RETENTION_DAYS` after they finish.
+
+No more than `BULK_INVITE_WORKERS` jobs run at once across all processes, to keep us within our
+SMTP and Auth0 quotas. Between slices, jobs go back in the queue, and the next slice goes to
+whichever inviter has waited longest, so one admin's big job doesn't hold up everyone else's.
+With several tenants (see `invite0.tenants`), they all share the one queue, and each job is run
+for the tenant it was submitted to.
+
+Provision jobs create the users up front, with Auth0 user import jobs of several thousand users
+each, rather than leaving each to sign up. Their addresses go from pending to importing (with
+the Auth0 job's ID) to imported, and then get invitations linking to a page for setting a
+password (see `views.activate`). Each slice either waits for the running import and invites
+the users it created, or starts the next import. Addresses are marked importing before their
+import is started, so that if we die before learning its ID, the retried slice imports them
+again, knowing that their users may have been created by the first try.
+"""
+import time
+import uuid
+from itertools import islice
+from threading import Event, Thread
+from types import SimpleNamespace
+from typing import Iterable, Optional
+
+from flask import current_app as app
+
+import invite0.config as conf
+from invite0 import db, profiling, tenants
+from invite0.auth0 import user_index
+from invite0.auth0.admin import import_users, user_import_results
+from invite0.auth0.exceptions import Auth0UnavailableError
+from invite0.bulk import send_bulk_invites
+from invite0.mail import send_job_report, send_job_failure_notice
+from invite0.tokens import recently_invited, record_invite
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id             INTEGER PRIMARY KEY,
+    inviter_email  TEXT NOT NULL,
+    state          TEXT NOT NULL DEFAULT 'queued',  -- draft, queued, done, or failed
+    created_at     REAL NOT NULL,
+    finished_at    REAL,
+    lease_id       TEXT,
+    leased_until   REAL,
+    last_leased_at REAL,
+    attempts       INTEGER NOT NULL DEFAULT 0,  -- consecutive failed slices
+    retry_at       REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state);
+
+CREATE TABLE IF NOT EXISTS job_addresses (
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    seq    INTEGER NOT NULL,
+    email  TEXT NOT NULL,
+    state  TEXT NOT NULL DEFAULT 'pending',  -- pending, skipped, sent, or failed (and see below)
+    PRIMARY KEY (job_id, seq)
+);
+CREATE INDEX IF NOT EXISTS job_addresses_by_state ON job_addresses (job_id, state, seq);
+CREATE INDEX IF NOT EXISTS job_addresses_by_email ON job_addresses (job_id, email);
+'''
+
+_MIGRATIONS = [
+    # progress reporting
+    '''
+    ALTER TABLE jobs ADD COLUMN started_at REAL;
+    ALTER TABLE job_addresses ADD COLUMN done_at REAL;
+    CREATE INDEX job_addresses_by_done_at ON job_addresses (job_id, done_at)
+    ''',
+    # provision jobs, whose addresses may also be importing or imported
+    '''
+    ALTER TABLE jobs ADD COLUMN kind TEXT NOT NULL DEFAULT 'invite';
+    ALTER TABLE job_addresses ADD COLUMN import_job TEXT
+    ''',
+    # addresses may also be already_invited, unless the job's to resend regardless
+    '''
+    ALTER TABLE jobs ADD COLUMN force_resend INTEGER NOT NULL DEFAULT 0
+    ''',
+    # jobs submitted by a profiled request are profiled too
+    '''
+    ALTER TABLE jobs ADD COLUMN profile INTEGER NOT NULL DEFAULT 0
+    ''',
+    # multi-tenant mode: the (server name of the) tenant the job's for, '' if single-tenant
+    '''
+    ALTER TABLE jobs ADD COLUMN tenant TEXT NOT NULL DEFAULT ''
+    ''',
+    # provision jobs: how many times the address's user import has been started (see
+    # `_start_import`)
+    '''
+    ALTER TABLE job_addresses ADD COLUMN import_attempts INTEGER NOT NULL DEFAULT 0
+    ''',
+]
+
+_SLICE_SIZE = 500  # addresses per lease
+_IMPORT_SIZE = 10000  # max addresses per user import, though the file size limit may cut it short
+_IMPORT_POLL_INTERVAL = 5  # seconds
+_SUBMIT_CHUNK_SIZE = 1000  # addresses per transaction when submitting a job
+_DRAFT_MAX_AGE = 60 * 60  # seconds before a job that was never fully submitted is deleted
+_LEASE_SECONDS = 120  # renewed after every address
+_POLL_INTERVAL = 5  # seconds
+_MAX_ATTEMPTS = 5
+_RETRY_BACKOFF = 30  # seconds, doubled after each failed attempt
+_RATE_WINDOW = 60  # seconds of history behind the `rate` in `progress`
+_PRUNE_INTERVAL = 60 * 60  # seconds between deletions of jobs older than `BULK_JOB_RETENTION_DAYS`
+
+_workers = SimpleNamespace(
+    threads=[],
+    wakeup=Event(),
+    pruned_at=0,  # see `_prune_finished`
+)
+
+
+class _LeaseLost(Exception):
+    """Another worker has taken over the job, eg because ours stalled past its lease"""
+
+
+def _db():
+    return db.connect('jobs', _SCHEMA, _MIGRATIONS)
+
+
+def submit_bulk_invite(email_addresses: Iterable[str], inviter_email: str,
+                       kind: str = 'invite', force_resend: bool = False,
+                       profile: bool = False) -> int:
+    """
+    Queue a bulk invite job and return its ID
+
+    `kind` is 'invite', or 'provision' to create the users up front (see above). Addresses sent
+    an invitation in the last `INVITE_RESEND_HOURS` are skipped, unless `force_resend`. With
+    `profile`, each slice of the job is profiled (see `invite0.profiling`).
+
+    `email_addresses` may be a generator (eg over an uploaded file). It's saved a chunk at a
+    time, so it needn't fit in memory, and the job isn't queued until it's exhausted. If it
+    raises, the job is deleted and the exception re-raised.
+    """
+    conn = _db()
+    with db.transaction(conn):
+        job_id = conn.execute(
+            '''
+            INSERT INTO jobs (tenant, inviter_email, kind, force_resend, profile, state, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''',
+            (tenants.current().name, inviter_email, kind, force_resend, profile, 'draft',
+             time.time())
+        ).lastrowid
+    address_cnt = 0
+    try:
+        numbered = enumerate(email_addresses)
+        while True:
+            chunk = [(job_id, seq, email_address)
+                     for seq, email_address in islice(numbered, _SUBMIT_CHUNK_SIZE)]
+            if not chunk:
+                break
+            with db.transaction(conn):
+                conn.executemany(
+                    'INSERT INTO job_addresses (job_id, seq, email) VALUES (?, ?, ?)', chunk
+                )
+            address_cnt += len(chunk)
+    except BaseException:
+        with db.transaction(conn):
+            conn.execute('DELETE FROM job_addresses WHERE job_id = ?', (job_id,))
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        raise
+    with db.transaction(conn):
+        conn.execute('UPDATE jobs SET state = ?, created_at = ? WHERE id = ?',
+                     ('queued', time.time(), job_id))
+    app.logger.info(f'Queued bulk {kind} job {job_id} ({address_cnt} addresses)')
+    _workers.wakeup.set()
+    return job_id
+
+
+def address_counts(job_id: int) -> dict:
+    """Number of the job's addresses in each state"""
+    rows = _db().execute(
+        'SELECT state, count(*) FROM job_addresses WHERE job_id = ? GROUP BY state', (job_id,)
+    )
+    counts = {'pending': 0, 'skipped': 0, 'already_invited': 0, 'sent': 0, 'failed': 0}
+    for state, count in rows:
+        # as far as anyone watching is concerned, importing and imported are still pending
+        counts[state if state in counts else 'pending'] += count
+    return counts
+
+
+def progress(job_id: int) -> Optional[dict]:
+    """
+    Summarize a job's progress, or return None if there's no such job (for this tenant)
+
+    `rate` is addresses/second over the last minute or so, and `eta_seconds` the time until the
+    job completes at that rate (None if unknown).
+    """
+    conn = _db()
+    job = conn.execute(
+        'SELECT * FROM jobs WHERE id = ? AND tenant = ?', (job_id, tenants.current().name)
+    ).fetchone()
+    if job is None:
+        return None
+    counts = address_counts(job_id)
+    now = time.time()
+    window = min(_RATE_WINDOW, now - (job['started_at'] or now))
+    recent_cnt = conn.execute(
+        'SELECT count(*) FROM job_addresses WHERE job_id = ? AND done_at > ?',
+        (job_id, now - window)
+    ).fetchone()[0]
+    rate = recent_cnt / window if window > 0 else 0.0
+    is_running = job['state'] == 'queued' and counts['pending']
+    return {
+        'id': job_id,
+        'state': job['state'],
+        'validated': sum(counts.values()),
+        **counts,
+        'rate': round(rate, 2),
+        'eta_seconds': round(counts['pending'] / rate) if is_running and rate else None,
+    }
+
+
+def queue_stats() -> dict:
+    """Numbers of active (leased) and unfinished jobs, and of addresses pending in the latter"""
+    conn = _db()
+    active_cnt, queued_cnt = conn.execute(
+        'SELECT coalesce(sum(leased_until > ?), 0), count(*) FROM jobs WHERE state = ?',
+        (time.time(), 'queued')
+    ).fetchone()
+    pending_cnt = conn.execute(
+        '''
+        SELECT count(*) FROM job_addresses
+        WHERE state IN ('pending', 'importing', 'imported')
+          AND job_id IN (SELECT id FROM jobs WHERE state = 'queued')
+        '''
+    ).fetchone()[0]
+    return {'active': active_cnt, 'queued': queued_cnt, 'pending': pending_cnt}
+
+
+def _lease_job():
+    """Take the next job due a slice, or return None if there isn't one or we're at capacity"""
+    conn = _db()
+    now = time.time()
+    with db.transaction(conn):
+        active_cnt = conn.execute(
+            'SELECT count(*) FROM jobs WHERE state = ? AND leased_until > ?', ('queued', now)
+        ).fetchone()[0]
+        if active_cnt >= conf.BULK_INVITE_WORKERS:
+            return None
+        tenant_names = tenants.names()
+        placeholders = ', '.join('?' * len(tenant_names))
+        job = conn.execute(
+            f'''
+            SELECT * FROM jobs
+            WHERE state = 'queued'
+              AND (leased_until IS NULL OR leased_until <= ?)
+              AND (retry_at IS NULL OR retry_at <= ?)
+              AND tenant IN ({placeholders})  -- eg not those of a tenant since removed
+            ORDER BY
+              (SELECT max(last_leased_at) FROM jobs AS j
+               WHERE j.tenant = jobs.tenant AND j.inviter_email = jobs.inviter_email),
+              last_leased_at,
+              id
+            LIMIT 1
+            ''',
+            (now, now, *tenant_names)
+        ).fetchone()
+        if job is None:
+            return None
+        lease_id = uuid.uuid4().hex
+        conn.execute(
+            '''
+            UPDATE jobs
+            SET lease_id = ?, leased_until = ?, last_leased_at = ?,
+                started_at = coalesce(started_at, ?)
+            WHERE id = ?
+            ''',
+            (lease_id, now + _LEASE_SECONDS, now, now, job['id'])
+        )
+    return SimpleNamespace(id=job['id'], kind=job['kind'], force_resend=job['force_resend'],
+                           profile=job['profile'], tenant=job['tenant'],
+                           inviter_email=job['inviter_email'], attempts=job['attempts'],
+                           lease_id=lease_id)
+
+
+def _renew_lease(conn, job):
+    renewed = conn.execute(
+        'UPDATE jobs SET leased_until = ? WHERE id = ? AND lease_id = ?',
+        (time.time() + _LEASE_SECONDS, job.id, job.lease_id)
+    ).rowcount
+    if not renewed:
+        raise _LeaseLost
+
+
+def _release_lease(conn, job, **updates):
+    assignments = ''.join(f', {column} = :{column}' for column in updates)
+    conn.execute(
+        f'UPDATE jobs SET lease_id = NULL, leased_until = NULL{assignments} '
+        'WHERE id = :id AND lease_id = :lease_id',
+        {'id': job.id, 'lease_id': job.lease_id, **updates}
+    )
+
+
+def _checkpoint(job, from_state):
+    """Return a `checkpoint` for the bulk invite engine, for addresses in `from_state`"""
+    def checkpoint(email_address, state):
+        conn = _db()  # called from the bulk invite engine's threads
+        with db.transaction(conn):
+            _renew_lease(conn, job)
+            # duplicates of the address share its fate
+            conn.execute(
+                '''
+                UPDATE job_addresses SET state = ?, done_at = ?
+                WHERE job_id = ? AND email = ? AND state = ?
+                ''',
+                (state, time.time(), job.id, email_address, from_state)
+            )
+        if state == 'sent':
+            record_invite(email_address, job.id)
+    return checkpoint
+
+
+def _send_invites(email_addresses, checkpoint, provisioned=False):
+    if conf.BULK_INVITE_MODE == 'asyncio':
+        from invite0 import aio  # only import aiohttp etc if we need them
+        aio.run(aio.send_bulk_invites(email_addresses, checkpoint, provisioned))
+    else:
+        send_bulk_invites(email_addresses, checkpoint, provisioned)
+
+
+def _addresses_in_state(job, state, limit):
+    return [row['email'] for row in _db().execute(
+        'SELECT email FROM job_addresses WHERE job_id = ? AND state = ? ORDER BY seq LIMIT ?',
+        (job.id, state, limit)
+    )]
+
+
+def _skip_recently_invited(job, email_addresses):
+    """Mark those of the pending `email_addresses` invited recently as such, and return the rest"""
+    if job.force_resend or not conf.INVITE_RESEND_HOURS:
+        return email_addresses
+    recent = recently_invited(email_addresses)
+    if recent:
+        conn = _db()
+        now = time.time()
+        with db.transaction(conn):
+            _renew_lease(conn, job)
+            conn.executemany(
+                '''
+                UPDATE job_addresses SET state = 'already_invited', done_at = ?
+                WHERE job_id = ? AND email = ? AND state = 'pending'
+                ''',
+                [(now, job.id, email_address) for email_address in recent]
+            )
+    return [email_address for email_address in email_addresses if email_address not in recent]
+
+
+def _run_slice(job):
+    if job.kind == 'provision':
+        _run_provision_slice(job)
+        return
+    conn = _db()
+    email_addresses = _addresses_in_state(job, 'pending', _SLICE_SIZE)
+    if not email_addresses:
+        _finish(job)
+        return
+
+    # checked before anything else, as it's by far the cheapest way to rule addresses out
+    email_addresses = _skip_recently_invited(job, email_addresses)
+    if email_addresses:
+        _send_invites(email_addresses, _checkpoint(job, 'pending'))
+    if address_counts(job.id)['pending']:
+        with db.transaction(conn):
+            _release_lease(conn, job, attempts=0, retry_at=None)
+    else:
+        _finish(job)
+
+
+def _wait_for_import(job, import_job):
+    """Wait for a user import to finish, and record which of its users were created"""
+    conn = _db()
+    while True:
+        results = user_import_results(import_job)
+        if results is not None:
+            break
+        with db.transaction(conn):
+            _renew_lease(conn, job)
+        time.sleep(_IMPORT_POLL_INTERVAL)
+    existing, failed = results
+    now = time.time()
+    with db.transaction(conn):
+        _renew_lease(conn, job)
+        # Users that already existed are skipped, unless an earlier try at importing them may
+        # have created them (see `_start_import`). Those are taken to be ours, and invited.
+        conn.executemany(
+            '''
+            UPDATE job_addresses SET state = 'skipped', done_at = ?
+            WHERE job_id = ? AND import_job = ? AND email = ? AND state = 'importing'
+                AND import_attempts <= 1
+            ''',
+            [(now, job.id, import_job, email_address) for email_address in existing]
+        )
+        conn.executemany(
+            '''
+            UPDATE job_addresses SET state = 'failed', done_at = ?
+            WHERE job_id = ? AND import_job = ? AND email = ? AND state = 'importing'
+            ''',
+            [(now, job.id, import_job, email_address) for email_address in failed]
+        )
+        imported = [row['email'] for row in conn.execute(
+            "SELECT email FROM job_addresses "
+            "WHERE job_id = ? AND import_job = ? AND state = 'importing'",
+            (job.id, import_job)
+        )]
+        conn.execute(
+            "UPDATE job_addresses SET state = 'imported' "
+            "WHERE job_id = ? AND import_job = ? AND state = 'importing'",
+            (job.id, import_job)
+        )
+    if conf.AUTH0_USER_INDEX:
+        for email_address in imported:
+            user_index.add(email_address)
+    app.logger.info(f'Bulk provision job {job.id}: imported {len(imported)} users, '
+                    f'{len(existing)} already existed, {len(failed)} failed ({import_job})')
+
+
+def _start_import(job, email_addresses):
+    """Start a user import for as many of `email_addresses` as fit in one"""
+    conn = _db()
+    # Recorded before the import is started, so that if we die before recording its ID, the
+    # addresses are still importing (without an import job) when the slice is retried.
+    with db.transaction(conn):
+        _renew_lease(conn, job)
+        conn.executemany(
+            '''
+            UPDATE job_addresses SET state = 'importing', import_attempts = import_attempts + 1
+            WHERE job_id = ? AND email = ? AND state IN ('pending', 'importing')
+                AND import_job IS NULL
+            ''',
+            [(job.id, email_address) for email_address in email_addresses]
+        )
+    import_job, import_cnt = import_users(email_addresses)
+    with db.transaction(conn):
+        _renew_lease(conn, job)
+        conn.executemany(
+            '''
+            UPDATE job_addresses SET import_job = ?
+            WHERE job_id = ? AND email = ? AND state = 'importing' AND import_job IS NULL
+            ''',
+            [(import_job, job.id, email_address) for email_address in email_addresses[:import_cnt]]
+        )
+        # those that didn't fit in the import file are as they were
+        conn.executemany(
+            '''
+            UPDATE job_addresses SET state = 'pending', import_attempts = import_attempts - 1
+            WHERE job_id = ? AND email = ? AND state = 'importing' AND import_job IS NULL
+            ''',
+            [(job.id, email_address) for email_address in email_addresses[import_cnt:]]
+        )
+        _release_lease(conn, job, attempts=0, retry_at=None)
+    app.logger.info(f'Bulk provision job {job.id}: importing {import_cnt} users ({import_job})')
+
+
+def _run_provision_slice(job):
+    conn = _db()
+    importing = conn.execute(
+        '''
+        SELECT import_job FROM job_addresses
+        WHERE job_id = ? AND state = 'importing' AND import_job IS NOT NULL LIMIT 1
+        ''',
+        (job.id,)
+    ).fetchone()
+    if importing is not None:
+        _wait_for_import(job, importing['import_job'])
+
+    email_addresses = _addresses_in_state(job, 'imported', _SLICE_SIZE)
+    if email_addresses:
+        _send_invites(email_addresses, _checkpoint(job, 'imported'), provisioned=True)
+        with db.transaction(conn):
+            _release_lease(conn, job, attempts=0, retry_at=None)
+        return
+
+    # any still importing were left so by a slice that died while starting their import
+    email_addresses = _addresses_in_state(job, 'importing', _IMPORT_SIZE)
+    if not email_addresses:
+        email_addresses = _addresses_in_state(job, 'pending', _IMPORT_SIZE)
+        if not email_addresses:
+            _finish(job)
+            return
+        email_addresses = _skip_recently_invited(job, email_addresses)
+        if not email_addresses:
+            with db.transaction(conn):
+                _release_lease(conn, job, attempts=0, retry_at=None)
+            return
+    _start_import(job, email_addresses)
+
+
+def _finish(job):
+    conn = _db()
+    with db.transaction(conn):
+        _renew_lease(conn, job)
+        _release_lease(conn, job, state='done', finished_at=time.time())
+    counts = address_counts(job.id)
+    app.logger.info(f'Bulk {job.kind} job {job.id} completed successfully: {counts}')
+    try:
+        send_job_report(job.inviter_email, counts)
+    except Exception:
+        app.logger.exception(f'Failed to send report for bulk invite job {job.id}')
+
+
+def _fail_slice(job):
+    conn = _db()
+    attempts = job.attempts + 1
+    with db.transaction(conn):
+        if attempts < _MAX_ATTEMPTS:
+            retry_at = time.time() + _RETRY_BACKOFF * 2 ** (attempts - 1)
+            _release_lease(conn, job, attempts=attempts, retry_at=retry_at)
+        else:
+            _release_lease(conn, job, attempts=attempts, state='failed', finished_at=time.time())
+    if attempts < _MAX_ATTEMPTS:
+        app.logger.warning(f'Bulk invite job {job.id} failed {attempts} times, will retry')
+    else:
+        app.logger.error(f'Giving up on bulk invite job {job.id}')
+        try:
+            send_job_failure_notice(job.inviter_email)
+        except Exception:
+            app.logger.exception(f'Failed to send failure notice for bulk invite job {job.id}')
+
+
+def _defer_slice(job):
+    conn = _db()
+    with db.transaction(conn):
+        _release_lease(conn, job, retry_at=time.time() + _RETRY_BACKOFF)
+
+
+def _work_on(app_obj, job):
+    """Run a slice of a leased job, for the job's tenant"""
+    # the tenant first, so that the app context's `url_for` makes the tenant's links
+    with tenants.use(tenants.get(job.tenant)), app_obj.app_context():
+        try:
+            if job.profile:
+                with profiling.job_profile(job.id):
+                    _run_slice(job)
+            else:
+                _run_slice(job)
+        except _LeaseLost:
+            app.logger.warning(f'Lost lease on bulk invite job {job.id}')
+        except Auth0UnavailableError:
+            # not the job's fault, so doesn't count towards `_MAX_ATTEMPTS`
+            app.logger.warning(f'Auth0 is down, pausing bulk invite job {job.id}')
+            _defer_slice(job)
+        except Exception:
+            app.logger.exception(f'Error during bulk invite job {job.id}')
+            _fail_slice(job)
+
+
+def _prune_finished():
+    """
+    Delete jobs that finished more than `BULK_JOB_RETENTION_DAYS` ago, addresses and all
+
+    Their addresses are personal data we've no more use for. Each job is deleted in a
+    transaction of its own, so as not to hold up the other workers for long.
+    """
+    now = time.time()
+    if now - _workers.pruned_at < _PRUNE_INTERVAL:
+        return
+    _workers.pruned_at = now
+    conn = _db()
+    expired = [row['id'] for row in conn.execute(
+        "SELECT id FROM jobs WHERE state IN ('done', 'failed') AND finished_at < ?",
+        (now - conf.BULK_JOB_RETENTION_DAYS * 60 * 60 * 24,)
+    )]
+    for job_id in expired:
+        with db.transaction(conn):
+            conn.execute('DELETE FROM job_addresses WHERE job_id = ?', (job_id,))
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+    if expired:
+        app.logger.info(f'Deleted {len(expired)} bulk invite jobs finished over '
+                        f'{conf.BULK_JOB_RETENTION_DAYS:g} days ago')
+
+
+def _work_forever(app_obj):
+    # necessary in order for `app.logger` to work because we're in a background thread
+    with app_obj.app_context():
+        while True:
+            try:
+                job = _lease_job()
+                if job is None:
+                    _prune_finished()
+                    _workers.wakeup.wait(_POLL_INTERVAL)
+                    _workers.wakeup.clear()
+                    continue
+                _work_on(app_obj, job)
+            except Exception:
+                # eg the database is locked or the disk is full -- don't let the worker die
+                app.logger.exception('Bulk invite worker error')
+                time.sleep(_POLL_INTERVAL)
+
+
+def start_workers(app_obj):
+    """Start this process's bulk invite workers. They'll resume any unfinished jobs."""
+    if _workers.threads:
+        return
+    with app_obj.app_context():
+        conn = _db()
+        with db.transaction(conn):
+            # left behind by a web worker that died during `submit_bulk_invite`
+            abandoned = 'SELECT id FROM jobs WHERE state = ? AND created_at < ?'
+            args = ('draft', time.time() - _DRAFT_MAX_AGE)
+            conn.execute(f'DELETE FROM job_addresses WHERE job_id IN ({abandoned})', args)
+            conn.execute(f'DELETE FROM jobs WHERE id IN ({abandoned})', args)
+        unfinished_cnt = conn.execute(
+            'SELECT count(*) FROM jobs WHERE state = ?', ('queued',)
+        ).fetchone()[0]
+        if unfinished_cnt:
+            app.logger.info(f'Resuming {unfinished_cnt} unfinished bulk invite jobs')
+    for i in range(conf.BULK_INVITE_WORKERS):
+        thread = Thread(
+            target=_work_forever,
+            args=[app_obj],
+            name=f'bulk-invite-worker-{i}',
+            daemon=True,
+        )
+        thread.start()
+        _workers.threads.append(thread)
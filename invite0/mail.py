@@ -1,101 +1,179 @@
 import time
-from threading import Thread
+from contextlib import contextmanager
+from smtplib import SMTPException, SMTPServerDisconnected
+from threading import BoundedSemaphore, Lock
+from types import SimpleNamespace
 
-from flask import render_template, url_for, current_app as app
-from flask_mail import Mail, Message
-
-from email_validator import validate_email, EmailNotValidError
+from flask import render_template, current_app as app
+from flask_mail import Connection, Mail, Message
+from jinja2 import TemplateNotFound
+from markupsafe import escape
 
 from invite0 import config as conf
-from invite0.auth0.admin import user_exists
-from invite0.tokens import generate_token
+from invite0 import metrics, profiling, tenants
+
+
+Mail(app)  # registers the extension, which `Message` reads a setting or two from
+
+
+def _mail():
+    """The current tenant's mail settings"""
+    return tenants.resource('mail', lambda: Mail().init_mail(app.config, app.debug, app.testing))
+
+
+def _close_pool(pool):
+    with pool.lock:
+        idle, pool.idle = pool.idle, []
+    for conn, _ in idle:
+        _close(conn)
+
+
+# Open, authenticated SMTP connections, kept so that each email doesn't pay for a TCP+TLS
+# handshake and AUTH. At most `MAIL_POOL_SIZE` connections are in use at once. The current
+# tenant's.
+_pool = tenants.local('mail_pool', lambda: SimpleNamespace(
+    lock=Lock(),
+    slots=BoundedSemaphore(conf.MAIL_POOL_SIZE),
+    idle=[],  # (connection, time returned to the pool), most recently returned last
+), close=_close_pool)
+_TRUST_IDLE_SECONDS = 5  # connections idle for longer get a NOOP before reuse
+
+
+def _is_alive(conn: Connection) -> bool:
+    if conn.host is None:  # sending is suppressed, eg when testing
+        return True
+    try:
+        return conn.host.noop()[0] == 250
+    except (SMTPException, OSError):
+        return False
+
+
+def _close(conn: Connection):
+    try:
+        conn.__exit__(None, None, None)
+    except (SMTPException, OSError):
+        pass  # already gone
+
+
+def _checkout() -> Connection:
+    while True:
+        with _pool.lock:
+            if not _pool.idle:
+                break
+            conn, returned_at = _pool.idle.pop()
+        if time.monotonic() - returned_at < _TRUST_IDLE_SECONDS or _is_alive(conn):
+            return conn
+        _close(conn)
+    with metrics.smtp_seconds.labels('connect').time():
+        return Connection(_mail()).__enter__()
+
+
+@contextmanager
+def pooled_connection():
+    """
+    Borrow an SMTP connection from the pool, blocking if all are in use
+
+    The connection reconnects by itself every `MAIL_MAX_EMAILS` emails (see
+    `flask_mail.Connection.send`). Send with `_send` to also reconnect if the server hangs up.
+    """
+    with _pool.slots:
+        conn = _checkout()
+        try:
+            yield conn
+        except BaseException:
+            returned_at = 0  # who knows what state it's in -- check it before reuse
+            raise
+        else:
+            returned_at = time.monotonic()
+        finally:
+            with _pool.lock:
+                _pool.idle.append((conn, returned_at))
+
 
+def _send(conn: Connection, message: Message):
+    try:
+        with metrics.smtp_seconds.labels('send').time():
+            conn.send(message)
+    except SMTPServerDisconnected:
+        # eg the server closed the connection while it sat idle in the pool
+        with metrics.smtp_seconds.labels('connect').time():
+            conn.host = conn.configure_host()
+        conn.num_emails = 0
+        with metrics.smtp_seconds.labels('send').time():
+            conn.send(message)
 
-_mail = Mail(app)
 
+@profiling.spanned('smtp')
+def _send_pooled(message: Message):
+    with pooled_connection() as conn:
+        _send(conn, message)
+
+
+_LINK_PLACEHOLDER = '__INVITE0_INVITE_LINK__'
+
+
+def _render_invitation_parts():
+    """
+    Render the invitation templates around a placeholder for the link, and split them there
+
+    The link is the only thing that differs between invitations, so this way we only have to
+    render the templates once rather than for every invitation, which adds up in bulk jobs.
+
+    :return: (html parts, plain text parts); plain text parts is None if the templates have been
+      overridden without an `invitation.txt`
+    """
+    html = render_template('invitation.html', invite_link=_LINK_PLACEHOLDER)
+    try:
+        text = render_template('invitation.txt', invite_link=_LINK_PLACEHOLDER)
+    except TemplateNotFound:
+        text = None
+    return html.split(_LINK_PLACEHOLDER), text and text.split(_LINK_PLACEHOLDER)
+
+
+def _invitation_message(email_address, link) -> Message:
+    if app.debug:
+        html_parts, text_parts = _render_invitation_parts()  # pick up template changes
+    else:
+        html_parts, text_parts = tenants.resource('invitation_parts', _render_invitation_parts)
 
-def send_invite(email_address, link, _conn=_mail):
     if conf.MAIL_SENDER_NAME:
         sender = (conf.MAIL_SENDER_NAME, conf.MAIL_SENDER_ADDRESS)
     else:
         sender = conf.MAIL_SENDER_ADDRESS
 
-    _conn.send(Message(
+    return Message(
         subject=conf.INVITE_SUBJECT,
         sender=sender,
         recipients=[email_address],
-        html=render_template('invitation.html', invite_link=link)
-    ))
+        html=str(escape(link)).join(html_parts),
+        body=link.join(text_parts) if text_parts else None,
+    )
+
+
+def send_invite(email_address, link, _conn=None):
+    message = _invitation_message(email_address, link)
+    if _conn is None:
+        _send_pooled(message)
+    else:
+        _send(_conn, message)
     app.logger.info(f'Invitation sent to {email_address}')
 
 
-def verify_addresses(email_addresses):
-    """
-    Validate multiple email addresses (for bulk invites)
+def send_job_report(inviter_email, counts):
+    _send_pooled(Message(
+        subject=f'{conf.ORG_NAME} | Your bulk invite job is complete',
+        sender=conf.MAIL_SENDER_ADDRESS,
+        recipients=[inviter_email],
+        html=f'invites sent: {counts["sent"]}, skipped (existing users): {counts["skipped"]}, '
+             f'skipped (invited recently): {counts["already_invited"]}, '
+             f'failed: {counts["failed"]}',
+    ))
 
-    :return: first invalid email address or None if all are valid
-    """
-    for email_address in email_addresses:
-        try:
-            # mimic wtforms.validators.Email
-            # https://github.com/wtforms/wtforms/blob/master/src/wtforms/validators.py#L384-L389
-            validate_email(
-                email_address,
-                check_deliverability=False,
-                allow_smtputf8=True,
-                allow_empty_local=False,
-            )
-        except EmailNotValidError:
-            return email_address
-    return None
-
-
-def _send_bulk_invite(email_addresses):
-    """Send invites to multiple email addresses"""
-    skip_cnt = 0
-    send_cnt = 0
-    with _mail.connect() as conn:
-        for email_address in email_addresses:
-            if user_exists(email_address):
-                skip_cnt += 1
-            else:
-                send_cnt += 1
-                token = generate_token(email_address)
-                link = url_for('signup', token=token, _external=True)
-                send_invite(email_address, link, conn)
-
-            # Auth0 free tier rate limits the Management API to 2 requests/second.
-            # This avoids that with plenty of wiggle room.
-            time.sleep(1)  # seconds
-    return skip_cnt, send_cnt
-
-
-def _send_bulk_invite_wrapper(email_addresses, inviter_email, app_obj):
-    """Wraps `_send_bulk_invite`, adding error handling/reporting and the app context"""
-    # necessary in order for `app.logger` to work because we're in a background thread
-    with app_obj.app_context():
-        try:
-            # yes, could just inline `_send_bulk_invite` but the indentation gets out of hand
-            skip_cnt, send_cnt = _send_bulk_invite(email_addresses)
-        except:
-            app.logger.exception('Error during bulk invite operation')
-            _mail.send(Message(
-                subject=f'{conf.ORG_NAME} | Oops! Your bulk invite job failed',
-                sender=conf.MAIL_SENDER_ADDRESS,
-                recipients=[inviter_email],
-                html=f'Sorry about that! Please ask your system administrator to check the logs.'
-            ))
-        else:
-            app.logger.info('Bulk invite job completed successfully')
-            _mail.send(Message(
-                subject=f'{conf.ORG_NAME} | Your bulk invite job is complete',
-                sender=conf.MAIL_SENDER_ADDRESS,
-                recipients=[inviter_email],
-                html=f'invites sent: {send_cnt}, skipped (existing users): {skip_cnt}',
-            ))
-
-def spawn_bulk_invite_job(email_addresses, inviter_email):
-    Thread(
-        target=_send_bulk_invite_wrapper,
-        args=[email_addresses, inviter_email, app._get_current_object()]
-    ).start()
+
+def send_job_failure_notice(inviter_email):
+    _send_pooled(Message(
+        subject=f'{conf.ORG_NAME} | Oops! Your bulk invite job failed',
+        sender=conf.MAIL_SENDER_ADDRESS,
+        recipients=[inviter_email],
+        html=f'Sorry about that! Please ask your system administrator to check the logs.'
+    ))
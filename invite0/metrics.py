@@ -0,0 +1,94 @@
+"""
+Prometheus metrics, served at /metrics
+
+Under gunicorn with our `gunicorn.conf.py`, `prometheus_multiproc_dir` is set, so each worker
+records its metrics in memory-mapped files there, and /metrics (served by whichever worker gets
+the scrape) adds up all of the workers' files. Recording is just a write to shared memory -- no
+I/O or cross-process locking -- so it's cheap enough for the hot paths it measures.
+
+Bulk job gauges are read from the jobs database at scrape time, since it's shared by all the
+workers anyway.
+"""
+import os
+import re
+
+from prometheus_client import (
+    CollectorRegistry,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+
+auth0_mgmt_request_seconds = Histogram(
+    'invite0_auth0_mgmt_request_seconds',
+    'Auth0 Management API requests',
+    ['method', 'resource', 'status'],
+)
+auth0_mgmt_rate_limit_remaining = Gauge(
+    'invite0_auth0_mgmt_rate_limit_remaining',
+    'Management API requests remaining before Auth0 rate limits us (X-RateLimit-Remaining), '
+    'as last seen by each worker',
+    multiprocess_mode='liveall',
+)
+auth0_mgmt_token_obtained = Gauge(
+    'invite0_auth0_mgmt_token_obtained_timestamp_seconds',
+    "When each worker's Management API access token was obtained",
+    multiprocess_mode='liveall',
+)
+auth0_oauth_seconds = Histogram(
+    'invite0_auth0_oauth_seconds',
+    'Round trips to the Auth0 Authentication API',
+    ['step'],  # authorization_code, userinfo, or client_credentials
+)
+smtp_seconds = Histogram(
+    'invite0_smtp_seconds',
+    'SMTP operations',
+    ['operation'],  # connect or send
+)
+http_request_seconds = Histogram(
+    'invite0_http_request_seconds',
+    'Time to handle requests, by view',
+    ['endpoint', 'method', 'status'],
+)
+
+# IDs in resource paths would make for a label value per user
+_RESOURCE_IDS = re.compile(r'^/(users|jobs|roles|connections|tickets)/[^/]+')
+
+
+def resource_label(resource: str) -> str:
+    """eg /users/auth0|1234/permissions -> /users/{id}/permissions"""
+    return _RESOURCE_IDS.sub(r'/\1/{id}', resource)
+
+
+class _JobsCollector:
+    def collect(self):
+        from invite0 import jobs  # jobs imports (indirectly) this module
+        stats = jobs.queue_stats()
+        yield GaugeMetricFamily(
+            'invite0_bulk_jobs_active', 'Bulk invite jobs being worked on', stats['active']
+        )
+        yield GaugeMetricFamily(
+            'invite0_bulk_jobs_queued', 'Unfinished bulk invite jobs', stats['queued']
+        )
+        yield GaugeMetricFamily(
+            'invite0_bulk_addresses_pending', 'Addresses yet to be done in unfinished bulk jobs',
+            stats['pending']
+        )
+
+
+_jobs_registry = CollectorRegistry()
+_jobs_registry.register(_JobsCollector())
+
+
+def render() -> bytes:
+    """The metrics in Prometheus's text format"""
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:  # eg `flask run`
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(_jobs_registry)
@@ -0,0 +1,232 @@
+"""
+Finding out where the time goes in slow requests and bulk jobs
+
+Timing breakdowns: every request keeps a tally of the time spent waiting on Auth0, on the mail
+server, and rendering templates (see `span`). It's a few additions per request, so it's always
+on, and requests that take longer than `SLOW_REQUEST_MS` are logged with their tally, eg:
+
+    Slow request: GET /admin 2412ms (auth0 1903ms/4, smtp 0ms/0, render 85ms/1, other 424ms)
+
+Profiles: a sampling profiler looks at the request's stack every `PROFILE_SAMPLE_MS` and writes
+what it saw to `DATA_DIR/profiles/` as folded stacks, which flamegraph.pl
+(https://github.com/brendangregg/FlameGraph) and https://www.speedscope.app read as they are.
+Only the latest `PROFILE_MAX_FILES` are kept.
+Sampling rather than tracing keeps the overhead low and the same however deep the stack. A
+request is profiled if
+- its endpoint is in `PROFILE_ENDPOINTS`, or
+- it has an `X-Invite0-Profile` header with a token from `/admin/profiling-token`, which only
+  users with the `PROFILE_PERMISSION` permission can get, and which lasts an hour
+A bulk job submitted by a profiled request is profiled too, a slice at a time. Its profile
+covers all of the process's bulk invite threads, which may include other jobs' if they run at
+the same time.
+
+Under gevent workers, the sampler (a thread) can't see into greenlets, so profiles are skipped,
+but timing breakdowns still work.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable
+
+from flask import current_app as app
+from flask import g, has_request_context, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from jinja2 import Template
+
+import invite0.config as conf
+from invite0 import tenants
+from invite0.concurrency import is_cooperative
+
+
+HEADER = 'X-Invite0-Profile'
+_TOKEN_MAX_AGE = 60 * 60  # seconds
+_SPAN_KINDS = ['auth0', 'smtp', 'render']
+
+# the current tenant's
+_serializer = tenants.local(
+    'profiling_serializer', lambda: URLSafeTimedSerializer(conf.SECRET_KEY, salt='profiling')
+)
+
+
+# timing breakdowns
+# --------------------------------------------------------------------------------------------------
+
+def add_span(kind: str, seconds: float):
+    """Count `seconds` towards the current request's time spent on `kind` (see `_SPAN_KINDS`)"""
+    if has_request_context():
+        spans = g.setdefault('spans', {})
+        total, count = spans.get(kind, (0.0, 0))
+        spans[kind] = (total + seconds, count + 1)
+
+
+@contextmanager
+def span(kind: str):
+    """Time the block as a span of `kind` (see `add_span`)"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(kind, time.perf_counter() - started_at)
+
+
+def spanned(kind: str):
+    """Decorator form of `span`"""
+    def decorator(func):
+        @wraps(func)
+        def decorated(*args, **kwargs):
+            with span(kind):
+                return func(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+class TimedTemplate(Template):
+    """A Jinja template whose rendering counts as a `render` span"""
+
+    def render(self, *args, **kwargs):
+        with span('render'):
+            return super().render(*args, **kwargs)
+
+
+def log_if_slow(elapsed: float):
+    """Log the current request's timing breakdown if it took longer than `SLOW_REQUEST_MS`"""
+    if not conf.SLOW_REQUEST_MS or elapsed * 1000 < conf.SLOW_REQUEST_MS:
+        return
+    spans = g.get('spans', {})
+    breakdown = [
+        f'{kind} {spans.get(kind, (0, 0))[0] * 1000:.0f}ms/{spans.get(kind, (0, 0))[1]}'
+        for kind in _SPAN_KINDS
+    ]
+    other = elapsed - sum(total for total, _ in spans.values())
+    app.logger.warning(f'Slow request: {request.method} {request.path} {elapsed * 1000:.0f}ms '
+                       f'({", ".join(breakdown)}, other {other * 1000:.0f}ms)')
+
+
+# profiles
+# --------------------------------------------------------------------------------------------------
+
+def make_token(user_id: str) -> str:
+    """A value for the `X-Invite0-Profile` header, for a user allowed to profile"""
+    return _serializer.dumps(user_id)
+
+
+def _has_valid_token() -> bool:
+    token = request.headers.get(HEADER)
+    if not token or not tenants.is_serving():  # eg /metrics at no tenant's domain
+        return False
+    try:
+        _serializer.loads(token, max_age=_TOKEN_MAX_AGE)
+    except BadSignature:
+        app.logger.warning(f'Ignoring invalid {HEADER} header')
+        return False
+    return True
+
+
+def wants_profile() -> bool:
+    """Whether the current request should be profiled"""
+    return request.endpoint in conf.PROFILE_ENDPOINTS or _has_valid_token()
+
+
+def _frame_name(frame) -> str:
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+
+class _Sampler:
+    """Samples the stacks of the threads that `include(thread)` picks, until stopped"""
+
+    def __init__(self, include: Callable[[threading.Thread], bool]):
+        self.include = include
+        self.stacks = Counter()  # 'root;caller;...;callee' -> samples
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample_forever, name='profiler',
+                                       daemon=True)
+
+    def _sample_forever(self):
+        interval = conf.PROFILE_SAMPLE_MS / 1000
+        while not self.stopped.wait(interval):
+            frames = sys._current_frames()
+            for thread in threading.enumerate():
+                frame = frames.get(thread.ident)
+                if frame is None or not self.include(thread):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(thread.name)
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, name: str):
+        """Stop sampling and write the profile, named after `name`"""
+        self.stopped.set()
+        self.thread.join()
+        directory = os.path.join(conf.DATA_DIR, 'profiles')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.folded")
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f'{stack} {count}\n')
+        app.logger.info(f'Wrote profile {path} ({sum(self.stacks.values())} samples)')
+        _prune_profiles(directory)
+
+
+def _prune_profiles(directory: str):
+    """Delete all but the latest `PROFILE_MAX_FILES` profiles"""
+    paths = [entry.path for entry in os.scandir(directory) if entry.name.endswith('.folded')]
+    # named for when they were written, so oldest first
+    for path in sorted(paths)[:-conf.PROFILE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # another process got to it first
+
+
+def _can_sample() -> bool:
+    if is_cooperative():
+        app.logger.warning("Can't profile under gevent, skipping.")
+        return False
+    return True
+
+
+def start_request_profile():
+    """Start profiling the current request, until `stop_request_profile`"""
+    if not _can_sample():
+        return
+    ident = threading.get_ident()
+    g.sampler = _Sampler(lambda thread: thread.ident == ident)
+    g.sampler.start()
+
+
+def stop_request_profile():
+    sampler = g.pop('sampler', None)
+    if sampler is not None:
+        sampler.stop(request.endpoint or 'none')
+
+
+def is_profiling() -> bool:
+    """Whether the current request is being profiled"""
+    return has_request_context() and 'sampler' in g
+
+
+@contextmanager
+def job_profile(job_id: int):
+    """Profile the enclosed slice of a bulk job, by sampling the bulk invite threads"""
+    if not _can_sample():
+        yield
+        return
+
+    sampler = _Sampler(
+        lambda thread: thread.name.startswith(('bulk-invite', 'asyncio-event-loop'))
+    )
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop(f'job-{job_id}')
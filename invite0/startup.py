@@ -0,0 +1,75 @@
+"""
+Startup timing, and warming a worker up before it serves any traffic
+
+Each worker logs how long it took to start, step by step, so that we can see what a cold start
+costs, eg when scaling up from zero.
+
+Some of the work is put off until something needs it, so that it stays out of the way of the
+worker starting up: importing authlib (for logging in) and WTForms and email_validator (for
+forms), compiling templates, and fetching the Management API token and, with
+`AUTH0_RBAC_TOKEN_PERMISSIONS`, the JWKS. Left at that, the first requests to need each of these
+pay for it. With `WARM_UP` set, `warm_up` does them all as the worker boots instead, before
+gunicorn hands it any requests. Compiled templates are kept in `DATA_DIR` and, with
+`AUTH0_MGMT_TOKEN_DIR`, the token is shared between workers, so mostly only the first worker to
+start pays for those.
+"""
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+
+
+started_at = time.perf_counter()  # when `invite0` started to be imported (this comes first)
+_steps: List[Tuple[str, float]] = []  # (step, seconds)
+
+
+@contextmanager
+def timed(step: str):
+    """Time the block as a step of startup"""
+    step_started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        _steps.append((step, time.perf_counter() - step_started_at))
+
+
+def log_breakdown(app):
+    total = time.perf_counter() - started_at
+    breakdown = ', '.join(f'{step} {seconds * 1000:.0f}ms' for step, seconds in _steps)
+    app.logger.info(f'Started in {total * 1000:.0f}ms: {breakdown}')
+
+
+def _import_forms():
+    import invite0.forms  # noqa -- and with it WTForms and email_validator
+
+
+def _compile_templates(app):
+    for name in app.jinja_env.list_templates(extensions=['html', 'txt']):
+        app.jinja_env.get_template(name)
+
+
+def warm_up(app):
+    """Do what the first requests would otherwise have to. Call in an app context."""
+    import invite0.config as conf
+    import invite0.auth0.management_client as auth0_mgmt
+    from invite0.auth0 import jwks, session
+
+    steps = [
+        ('forms', _import_forms),
+        ('templates', lambda: _compile_templates(app)),
+    ]
+    # with several tenants, their clients are made as each tenant needs them (see `tenants`)
+    if not conf.TENANTS_FILE:
+        steps += [
+            ('oauth client', session._oauth_client),
+            ('management token', auth0_mgmt._access_token),
+        ]
+        if conf.AUTH0_RBAC_TOKEN_PERMISSIONS:
+            steps.append(('jwks', jwks.fetch_keys))
+    for name, step in steps:
+        with timed(f'warm-up {name}'):
+            try:
+                step()
+            except Exception:
+                # eg Auth0 is down -- the worker can still serve what it can, and the first
+                # request that needs this will try again
+                app.logger.exception(f'Failed to warm up ({name}), carrying on without.')
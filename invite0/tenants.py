@@ -0,0 +1,248 @@
+"""
+Serving several Auth0 tenants from one deployment (`TENANTS_FILE`)
+
+Without `TENANTS_FILE` there's just the one tenant, configured by the environment as usual, and
+none of this makes any difference.
+
+With it, each tenant is served at its own domain (its `SERVER_NAME`, with the port if it's not
+the default), and requests are routed to tenants by their `Host` header. Requests for any other
+host get a 404, except for /metrics, which is the same for all tenants, so it's served there
+rather than at their domains -- scrape it by IP address, say. The tenants file is JSON, mapping
+each tenant's domain to its own values of the settings in `config.TENANT_KEYS`, eg:
+
+    {
+        "join.acme.com": {"ORG_NAME": "Acme", "AUTH0_DOMAIN": "acme.eu.auth0.com", ...},
+        "signup.example.org": {"ORG_NAME": "Example", "AUTH0_DOMAIN": "example.auth0.com", ...}
+    }
+
+Settings left out fall back to the environment, so eg a mail server shared by all tenants need
+only be set once. Everything else (`DATA_DIR`, `BULK_INVITE_*`, pool sizes...) is shared.
+
+The current tenant is kept in a context variable, set for the duration of each request (see
+`_select_tenant`) and of each slice of a bulk job, and carried over by hand to the threads that
+work for them. `invite0.config` and `app.config` look the tenant's settings up in it, so
+`conf.AUTH0_DOMAIN` is the current tenant's.
+
+What was a single, module-level object per process -- the Management API session, token, rate
+limiter, breaker, and cache, the OAuth client, the token serializer, the SMTP pool -- is one per
+tenant instead, made the first time the tenant needs it (see `local`). Those of tenants that
+haven't been used for `TENANT_IDLE_SECONDS` are closed and dropped, to be made again should the
+tenant come back, so that dozens of mostly idle tenants don't each hold connections open.
+
+Tenants' invitation ledgers and user indexes are in databases of their own. Bulk invite jobs
+share the one queue (and `BULK_INVITE_WORKERS`), each job run in its tenant's context.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock, RLock
+from types import SimpleNamespace
+from typing import Callable, List, Optional
+
+from flask import Config, current_app as app
+from werkzeug.exceptions import NotFound
+from werkzeug.local import LocalProxy
+from werkzeug.wsgi import ClosingIterator, get_host
+
+import invite0.config as conf
+
+
+_SWEEP_INTERVAL = 60  # seconds between looks for idle tenants
+
+_current = ContextVar('tenant', default=None)
+
+_tenants = SimpleNamespace(
+    lock=Lock(),
+    by_name={},  # server name -> tenant
+    default=None,  # the one and only tenant, when not multi-tenant
+    swept_at=time.monotonic(),
+)
+
+
+def _new_tenant(name: str, config: dict) -> SimpleNamespace:
+    return SimpleNamespace(
+        name=name,
+        config=config,
+        lock=RLock(),  # so that making a resource can make the others it needs
+        resources={},  # name -> (resource, close)
+        active=0,  # contexts using the tenant right now
+        last_used=time.monotonic(),
+    )
+
+
+if conf.TENANTS_FILE:
+    for _name, _config in conf.TENANTS.items():
+        _tenants.by_name[_name] = _new_tenant(_name, _config)
+else:
+    _tenants.default = _new_tenant('', {key: getattr(conf, key) for key in conf.TENANT_KEYS})
+
+
+def current() -> SimpleNamespace:
+    """The tenant being served"""
+    tenant = _current.get() or _tenants.default
+    if tenant is None:
+        raise RuntimeError('Not working for any tenant -- see `invite0.tenants.use`.')
+    return tenant
+
+
+def get(name: str) -> SimpleNamespace:
+    """:raise KeyError: if there's no such tenant"""
+    if _tenants.default is not None and name == _tenants.default.name:
+        return _tenants.default
+    return _tenants.by_name[name]
+
+
+def is_serving() -> bool:
+    """Whether there's a current tenant"""
+    return (_current.get() or _tenants.default) is not None
+
+
+def names() -> List[str]:
+    if _tenants.default is not None:
+        return [_tenants.default.name]
+    return list(_tenants.by_name)
+
+
+def enter(tenant):
+    """Start working for `tenant`. Pass the returned token to `leave` to stop."""
+    with tenant.lock:
+        tenant.active += 1
+        tenant.last_used = time.monotonic()
+    return _current.set(tenant)
+
+
+def leave(token):
+    tenant = _current.get()
+    _current.reset(token)
+    with tenant.lock:
+        tenant.active -= 1
+        tenant.last_used = time.monotonic()
+    _evict_idle()
+
+
+@contextmanager
+def use(tenant):
+    """Work for `tenant` in the enclosed block"""
+    token = enter(tenant)
+    try:
+        yield tenant
+    finally:
+        leave(token)
+
+
+def scoped(name: str) -> str:
+    """Name for the current tenant's own `name`, eg a database. Just `name` if single-tenant."""
+    tenant = current()
+    return f'{name}-{tenant.name}' if tenant.name else name
+
+
+# per-tenant resources
+# --------------------------------------------------------------------------------------------------
+
+def resource(name: str, create: Callable, close: Optional[Callable] = None):
+    """
+    The current tenant's `name`, made with `create()` the first time it's asked for
+
+    :param close: called with the resource if it's dropped because the tenant is idle
+    """
+    tenant = current()
+    try:
+        return tenant.resources[name][0]
+    except KeyError:
+        pass
+    with tenant.lock:
+        if name not in tenant.resources:
+            tenant.resources[name] = (create(), close)
+        return tenant.resources[name][0]
+
+
+def local(name: str, create: Callable, close: Optional[Callable] = None) -> LocalProxy:
+    """
+    A stand-in for a module-level object, that's really the current tenant's own (see `resource`)
+
+    Attributes are got and set on the current tenant's object, so eg `_self.token = ...` works
+    as it would if `_self` were a plain `SimpleNamespace`.
+    """
+    return LocalProxy(lambda: resource(name, create, close))
+
+
+def _evict_idle():
+    if _tenants.default is not None:
+        return  # the only tenant is never idle for long enough to matter
+    now = time.monotonic()
+    with _tenants.lock:
+        if now - _tenants.swept_at < _SWEEP_INTERVAL:
+            return
+        _tenants.swept_at = now
+    for tenant in _tenants.by_name.values():
+        with tenant.lock:
+            if (tenant.active or not tenant.resources
+                    or now - tenant.last_used < conf.TENANT_IDLE_SECONDS):
+                continue
+            resources, tenant.resources = tenant.resources, {}
+        for name, (obj, close) in resources.items():
+            if close is None:
+                continue
+            try:
+                close(obj)
+            except Exception:
+                app.logger.exception(f'Failed to close {name} of idle tenant {tenant.name}')
+        app.logger.info(f'Dropped the clients of idle tenant {tenant.name}')
+
+
+# Flask
+# --------------------------------------------------------------------------------------------------
+
+class _TenantConfig(Config):
+    """`app.config`, except that `config.TENANT_KEYS` are the current tenant's (None outside one)"""
+
+    def __getitem__(self, key):
+        if key in conf.TENANT_KEYS:
+            tenant = _current.get()
+            return None if tenant is None else tenant.config[key]
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        if key in conf.TENANT_KEYS:
+            return self[key]
+        return super().get(key, default)
+
+
+def _select_tenant(wsgi_app):
+    """
+    WSGI middleware that serves each request for the tenant at the host requested
+
+    It's done this early, rather than in a `before_request`, as Flask needs the tenant's
+    `SECRET_KEY` to open the session and its `SERVER_NAME` to route the request. The tenant is
+    left only once the response has been sent, so streamed responses are still the tenant's.
+    """
+    def select_tenant(environ, start_response):
+        tenant = _tenants.by_name.get(get_host(environ).lower())
+        if tenant is None:
+            if environ.get('PATH_INFO') == '/metrics':
+                return wsgi_app(environ, start_response)
+            return NotFound()(environ, start_response)
+        if environ.get('PATH_INFO') == '/metrics':
+            return NotFound()(environ, start_response)  # so it's not public wherever they are
+        token = enter(tenant)
+        try:
+            response = wsgi_app(environ, start_response)
+        except BaseException:
+            leave(token)
+            raise
+        return ClosingIterator(response, callbacks=[lambda: leave(token)])
+    return select_tenant
+
+
+def init_app(app_obj):
+    """Route requests to tenants, and look their settings up in `app.config`, if multi-tenant"""
+    if not conf.TENANTS_FILE:
+        return
+    app_obj.wsgi_app = _select_tenant(app_obj.wsgi_app)
+    # eg `SECRET_KEY` for the session cookie and CSRF tokens, `SERVER_NAME` for `url_for` in
+    # background app contexts (so push those *after* entering the tenant), and the
+    # `config.ORG_NAME`s in the templates
+    app_obj.config = _TenantConfig(app_obj.root_path, app_obj.config)
+    # Flask would otherwise set the session cookie for the domain of whichever tenant's request
+    # came first, and remember that for all of them. Without, it's for the host requested.
+    app_obj.config['SESSION_COOKIE_DOMAIN'] = False
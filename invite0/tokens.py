@@ -1,9 +1,54 @@
+import hashlib
+import time
+from itertools import islice
+from typing import Iterable, Optional, Set
+
 from itsdangerous import URLSafeTimedSerializer
 
 import invite0.config as conf
+from invite0 import db, tenants
+
+
+# the current tenant's. Activation links (see `views.activate`) get a salt of their own, so that
+# signup links can't be used as them, nor they as signup links.
+_serializer = tenants.local('token_serializer', lambda: URLSafeTimedSerializer(conf.SECRET_KEY))
+_activation_serializer = tenants.local(
+    'activation_serializer', lambda: URLSafeTimedSerializer(conf.SECRET_KEY, salt='activate')
+)
+
+# - tokens that have been used to sign up, so that replayed links can be turned away without a
+#   round trip to Auth0. Tokens are stored as truncated digests, since we only need to recognize
+#   them, and only until they'd have expired anyway.
+# - the latest invitation sent to each address, so that overlapping lists don't get people
+#   invited again and again (see `INVITE_RESEND_HOURS`). Also only kept until it'd have expired.
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS consumed_tokens (
+    digest      BLOB PRIMARY KEY,
+    consumed_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS consumed_tokens_by_consumed_at ON consumed_tokens (consumed_at);
+
+CREATE TABLE IF NOT EXISTS sent_invites (
+    email   TEXT PRIMARY KEY,  -- normalized, see `invite0.addresses`
+    sent_at REAL NOT NULL,
+    job_id  INTEGER  -- null for single invites
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sent_invites_by_sent_at ON sent_invites (sent_at);
+'''
+_DIGEST_SIZE = 16  # bytes
+_LOOKUP_CHUNK_SIZE = 500  # addresses per query, within SQLite's limit on parameters
+
 
+def _db():
+    return db.connect(tenants.scoped('tokens'), _SCHEMA)
 
-_serializer = URLSafeTimedSerializer(conf.SECRET_KEY)
+
+def _digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()[:_DIGEST_SIZE]
+
+
+def _max_age_seconds() -> float:
+    return float(conf.INVITE_EXPIRATION_DAYS) * 60 * 60 * 24
 
 
 def generate_token(email_address: str) -> str:
@@ -27,5 +72,65 @@ def read_token(token: str) -> str:
     deserialized and returned.
     """
 
-    max_age_seconds = conf.INVITE_EXPIRATION_DAYS * 60 * 60 * 24
-    return _serializer.loads(token, max_age=max_age_seconds)
+    return _serializer.loads(token, max_age=_max_age_seconds())
+
+
+def generate_activation_token(email_address: str) -> str:
+    """Like `generate_token`, but for activating an account made by a provision job"""
+    return _activation_serializer.dumps(email_address)
+
+
+def read_activation_token(token: str) -> str:
+    """Like `read_token`, but for tokens from `generate_activation_token`"""
+    return _activation_serializer.loads(token, max_age=_max_age_seconds())
+
+
+def is_consumed(token: str) -> bool:
+    """Whether the token has already been used to sign up or activate (see `mark_consumed`)"""
+    return _db().execute(
+        'SELECT 1 FROM consumed_tokens WHERE digest = ?', (_digest(token),)
+    ).fetchone() is not None
+
+
+def mark_consumed(token: str):
+    """Record that the token has been used to sign up or activate, so it can't be used again"""
+    conn = _db()
+    now = time.time()
+    with db.transaction(conn):
+        conn.execute(
+            'INSERT OR IGNORE INTO consumed_tokens (digest, consumed_at) VALUES (?, ?)',
+            (_digest(token), now)
+        )
+        # anything consumed this long ago has expired, so `read_token` will reject it by itself
+        conn.execute(
+            'DELETE FROM consumed_tokens WHERE consumed_at < ?', (now - _max_age_seconds(),)
+        )
+
+
+def recently_invited(email_addresses: Iterable[str]) -> Set[str]:
+    """:return: those of `email_addresses` sent an invitation in the last `INVITE_RESEND_HOURS`"""
+    conn = _db()
+    since = time.time() - conf.INVITE_RESEND_HOURS * 60 * 60
+    email_addresses = iter(email_addresses)
+    found = set()
+    while True:
+        chunk = list(islice(email_addresses, _LOOKUP_CHUNK_SIZE))
+        if not chunk:
+            return found
+        placeholders = ', '.join('?' * len(chunk))
+        found.update(row[0] for row in conn.execute(
+            f'SELECT email FROM sent_invites WHERE email IN ({placeholders}) AND sent_at > ?',
+            (*chunk, since)
+        ))
+
+
+def record_invite(email_address: str, job_id: Optional[int] = None):
+    """Record that an invitation was sent (see `recently_invited`)"""
+    conn = _db()
+    now = time.time()
+    with db.transaction(conn):
+        conn.execute(
+            'INSERT OR REPLACE INTO sent_invites (email, sent_at, job_id) VALUES (?, ?, ?)',
+            (email_address, now, job_id)
+        )
+        conn.execute('DELETE FROM sent_invites WHERE sent_at < ?', (now - _max_age_seconds(),))
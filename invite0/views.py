@@ -1,17 +1,73 @@
+import csv
+import hmac
+import json
+import time
+
 from flask import current_app as app
-from flask import redirect, render_template, flash, url_for
+from flask import redirect, render_template, flash, url_for, jsonify, Response, g, request
 
 from itsdangerous import SignatureExpired, BadSignature
 
 import invite0.config as conf
 from invite0 import data
-from invite0.forms import SignUpForm, InviteForm, BulkInviteForm, ProfileForm
-from invite0.tokens import generate_token, read_token
-from invite0.auth0.admin import user_exists, create_user
-from invite0.mail import send_invite, spawn_bulk_invite_job, verify_addresses
+from invite0.tokens import generate_token, read_token, is_consumed, mark_consumed
+from invite0.tokens import read_activation_token
+from invite0.tokens import recently_invited, record_invite
+from invite0.auth0.admin import user_exists, create_user, password_change_ticket
+from invite0.mail import send_invite
+from invite0 import addresses, jobs, metrics, profiling
 from invite0.auth0 import session
 from invite0.auth0.session import current_user, requires_login, requires_permission
 from invite0.auth0 import exceptions
+from invite0.concurrency import is_cooperative
+
+
+_PROGRESS_POLL_MS = 3000  # see `admin_job`
+_EVENT_STREAM_SECONDS = 15  # see `admin_job_events`
+_EVENT_RETRY_MS = 1000
+
+# `invite0.forms` is imported by the views that use it, so that WTForms (and email_validator)
+# aren't imported until a form is needed -- see `invite0.startup`
+
+
+@app.before_request
+def start_timer():
+    g.request_started_at = time.perf_counter()
+    if profiling.wants_profile():
+        profiling.start_request_profile()
+
+
+@app.after_request
+def record_duration(response):
+    elapsed = time.perf_counter() - g.request_started_at
+    metrics.http_request_seconds.labels(
+        request.endpoint or 'none', request.method, response.status_code
+    ).observe(elapsed)
+    profiling.log_if_slow(elapsed)
+    return response
+
+
+@app.teardown_request
+def finish_profile(exc):
+    # here rather than in `record_duration`, so that requests that raise are profiled too
+    profiling.stop_request_profile()
+
+
+@app.errorhandler(exceptions.Auth0UnavailableError)
+def auth0_unavailable(e):
+    message = "We're having trouble reaching our login provider. Please try again in a minute."
+    return render_template('error.html', message=message), 503
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if conf.METRICS_TOKEN:
+        expected = f'Bearer {conf.METRICS_TOKEN}'
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            return Response('Unauthorized', 401, {'WWW-Authenticate': 'Bearer'},
+                            mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 
 @app.route('/')
 def index():
@@ -48,6 +104,7 @@ def my_account():
 @app.route('/my-account/edit', methods=['GET', 'POST'])
 @requires_login
 def my_account_edit():
+    from invite0.forms import ProfileForm
     # TODO: handle 400s from Auth0 gracefully
     form = ProfileForm(data=current_user.profile)
     if form.validate_on_submit():
@@ -74,38 +131,114 @@ def password_reset():
 @requires_login
 @requires_permission(conf.INVITE_PERMISSION)
 def admin():
+    from invite0.forms import InviteForm, BulkInviteForm
     single_form = InviteForm()
     if single_form.submit_single.data and single_form.validate_on_submit():
-        email_address = single_form.email.data
-        if user_exists(email_address):
+        email_address = addresses.normalize(single_form.email.data)
+        if not single_form.force_resend.data and recently_invited([email_address]):
+            flash('This email address was sent an invitation recently. '
+                  'To send another anyway, check "Send even if invited recently".', 'is-warning')
+        elif user_exists(email_address):
             flash('An account already exists for this email address.', 'is-danger')
         else:
             token = generate_token(email_address)
             link = url_for('signup', token=token, _external=True)
             send_invite(email_address, link)
+            record_invite(email_address)
             flash(f'Invitation sent to {email_address}!', 'is-success')
             return redirect('/admin')
 
     bulk_form = BulkInviteForm()
+    invalid_rows = []
+    invalid_count = 0
     if bulk_form.submit_bulk.data and bulk_form.validate_on_submit():
-        email_addresses = bulk_form.emails.data.replace(',', ' ').split()
-        bad_address = verify_addresses(email_addresses)
-        if bad_address:
-            flash(f'{bad_address} is not a valid email address. '
-                   'Please correct or remove this value and try again.', 'is-danger')
+        if bulk_form.emails_file.data:
+            rows = addresses.from_file(bulk_form.emails_file.data.stream)
+        else:
+            rows = addresses.from_text(bulk_form.emails.data)
+        inviter_email = current_user.profile['email']
+        kind = 'provision' if bulk_form.provision.data else 'invite'
+        try:
+            job_id = jobs.submit_bulk_invite(addresses.checked(rows), inviter_email, kind,
+                                             force_resend=bulk_form.force_resend.data,
+                                             profile=profiling.is_profiling())
+        except addresses.InvalidAddressesError as e:
+            invalid_rows, invalid_count = e.rows, e.count
+            listed = 'listed' if e.count == len(e.rows) else f'the first {len(e.rows)} listed'
+            flash(f'{e.count} invalid email addresses ({listed} below). '
+                   'Please correct or remove them and try again.', 'is-danger')
+        except (UnicodeDecodeError, csv.Error):
+            flash("Sorry, I couldn't read that file. "
+                  'Please upload a UTF-8 encoded CSV or text file.', 'is-danger')
         else:
-            inviter_email = current_user.profile['email']
-            spawn_bulk_invite_job(email_addresses, inviter_email)
-
             flash(f'Bulk invite job initiated. You will recieve an email at {inviter_email} '
                    'when it is complete.', 'is-success')
-            return redirect('/admin')
+            return redirect(url_for('admin_job', job_id=job_id))
+
+    return render_template('admin.html', single_form=single_form, bulk_form=bulk_form,
+                           invalid_rows=invalid_rows, invalid_count=invalid_count)
+
+
+@app.route('/admin/profiling-token')
+@requires_login
+@requires_permission(conf.PROFILE_PERMISSION)
+def admin_profiling_token():
+    """A value for the `X-Invite0-Profile` header, to profile requests -- see `invite0.profiling`"""
+    return Response(profiling.make_token(current_user.user_id), mimetype='text/plain')
+
 
-    return render_template('admin.html', single_form=single_form, bulk_form=bulk_form)
+@app.route('/admin/jobs/<int:job_id>')
+@requires_login
+@requires_permission(conf.INVITE_PERMISSION)
+def admin_job(job_id):
+    progress = jobs.progress(job_id)
+    if progress is None:
+        return render_template('error.html', message="There's no such job.")
+    # a stream ties up a sync worker, so the page polls `admin_job_progress` unless under gevent
+    return render_template('admin-job.html', progress=progress, stream=is_cooperative(),
+                           poll_ms=_PROGRESS_POLL_MS)
+
+
+@app.route('/admin/jobs/<int:job_id>/progress')
+@requires_login
+@requires_permission(conf.INVITE_PERMISSION)
+def admin_job_progress(job_id):
+    progress = jobs.progress(job_id)
+    if progress is None:
+        return jsonify(error='No such job'), 404
+    return jsonify(progress)
+
+
+@app.route('/admin/jobs/<int:job_id>/events')
+@requires_login
+@requires_permission(conf.INVITE_PERMISSION)
+def admin_job_events(job_id):
+    """
+    Stream the job's progress as server-sent events, under gevent workers only
+
+    A stream would occupy a whole sync worker (and the Dockerfile runs just the one), so with
+    those the job page polls `admin_job_progress` instead. Streams are still closed after
+    `_EVENT_STREAM_SECONDS`, and the browser's `EventSource` reconnects by itself.
+    """
+    if not is_cooperative():
+        return jsonify(error='Progress is only streamed under gevent workers'), 404
+
+    def stream():
+        yield f'retry: {_EVENT_RETRY_MS}\n\n'
+        deadline = time.monotonic() + _EVENT_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            progress = jobs.progress(job_id)
+            yield f'data: {json.dumps(progress)}\n\n'
+            if progress is None or progress['state'] != 'queued':
+                break
+            time.sleep(1)
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/signup/<token>', methods=['GET', 'POST'])
 def signup(token):
+    from invite0.forms import SignUpForm
+
     def error_page(message):
         # TODO: Use Flask error handling
         # https://flask.palletsprojects.com/en/1.1.x/errorhandling/#error-handlers
@@ -118,6 +251,9 @@ def signup(token):
     except BadSignature:
         app.logger.warning('Recieved invalid invitation token')
         return error_page("There's something wrong with this invitation link. Are you lost?")
+    if is_consumed(token):
+        app.logger.info('Recieved already-used invitation token')
+        return error_page('This invitation link has already been used.')
 
     form = SignUpForm()
     if form.validate_on_submit():
@@ -129,11 +265,13 @@ def signup(token):
         except exceptions.PasswordNoUserInfoError:
             flash('Password must not contain user information (eg email/username).', 'is-danger')
         except exceptions.UserAlreadyExistsError:
+            mark_consumed(token)
             flash('An account already exists for your email address.', 'is-danger')
             # TODO: password reset link
         except Exception as e:
             flash('An unknown error occured.', 'is-danger')
         else:
+            mark_consumed(token)
             flash('Account created!', 'is-success')
             if conf.WELCOME_URL:
                 return redirect(conf.WELCOME_URL)
@@ -145,3 +283,42 @@ def signup(token):
         form=form,
         hide_logout_button=False,
     )
+
+
+@app.route('/activate/<token>', methods=['GET', 'POST'])
+def activate(token):
+    """Where users created by a provision job (see `jobs`) land from their invitation"""
+    from invite0.forms import ActivateForm
+
+    def error_page(message):
+        return render_template('error.html', message=message, hide_logout_button=True)
+    try:
+        email_address = read_activation_token(token)
+    except SignatureExpired:
+        app.logger.info('Recieved expired activation token')
+        return error_page('This link has expired. Please ask for a new one.')
+    except BadSignature:
+        app.logger.warning('Recieved invalid activation token')
+        return error_page("There's something wrong with this link. Are you lost?")
+    # otherwise whoever has the email could keep setting the user's password
+    if is_consumed(token):
+        app.logger.info('Recieved already-used activation token')
+        return error_page('This link has already been used. '
+                          'To set a new password, reset it from the login page.')
+
+    form = ActivateForm()
+    if not form.validate_on_submit():
+        # The link is only used up once the form is submitted, not by merely following it, as
+        # mail scanners and link previews do before the invitee gets to it.
+        return render_template('activate.html', form=form, email_address=email_address,
+                               hide_logout_button=True)
+
+    # on to Auth0 to set a password, and then back to us
+    result_url = conf.WELCOME_URL or url_for('my_account', _external=True)
+    try:
+        ticket = password_change_ticket(email_address, result_url)
+    except exceptions.UserNotFoundError:
+        app.logger.warning(f'Recieved activation token for missing user {email_address}')
+        return error_page("Sorry, there's no longer an account for this link.")
+    mark_consumed(token)
+    return redirect(ticket)